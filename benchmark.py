@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+# Benchmark the pins API and the input edge pipeline on a simulated GPIO
+#
+#   python3 benchmark.py                    run all the scenarios
+#   python3 benchmark.py -o before.json     also save the results
+#   python3 benchmark.py --compare before.json after.json
+
+import argparse, contextlib, importlib.util, json, os, platform, subprocess, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Event
+
+os.environ['GPIO_BACKEND'] = 'sim'
+import requests
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_app():
+    """ Import restful-pi-sigbox.py, which can't be imported by name """
+    spec = importlib.util.spec_from_file_location('sigbox', os.path.join(HERE, 'restful-pi-sigbox.py'))
+    sigbox = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sigbox)
+    return sigbox
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarise(samples):
+    """ Latency stats and a log-scale histogram, in millisecs """
+    ms = [s * 1000 for s in samples]
+    buckets = {}
+    for v in ms:
+        edge = 0.1
+        while v > edge:
+            edge *= 2
+        buckets[edge] = buckets.get(edge, 0) + 1
+    return {
+        'count': len(ms),
+        'min': min(ms),
+        'p50': percentile(ms, 50),
+        'p90': percentile(ms, 90),
+        'p99': percentile(ms, 99),
+        'max': max(ms),
+        'histogram': {f"<={edge:g}": buckets[edge] for edge in sorted(buckets)},
+    }
+
+
+def print_summary(title, stats):
+    print(f"{title}: n={stats['count']} p50={stats['p50']:.2f}ms p90={stats['p90']:.2f}ms "
+          f"p99={stats['p99']:.2f}ms max={stats['max']:.2f}ms")
+    biggest = max(stats['histogram'].values())
+    for bucket, count in stats['histogram'].items():
+        print(f"  {bucket:>10}ms {count:6d} {'#' * max(1, round(40 * count / biggest))}")
+
+
+class Stub(BaseHTTPRequestHandler):
+    """ Stands in for the signalling server, noting when each request arrives """
+    arrivals = {}
+
+    def do_GET(self):
+        event = self.arrivals.get(self.path)
+        if event is not None:
+            event[1] = time.monotonic()
+            event[0].set()
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+def serve(server):
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def build_layout(sigbox, stub_url, pins):
+    """ A block-style layout: outputs, plus inputs calling the stub server """
+    sigbox.pin_util = pin_util = sigbox.PinUtil()
+    for n in range(pins):
+        pin_util.create({'pin_num': 2 + n, 'name': f'out-{n}', 'state': 'off', 'direction': 'out'})
+    for n in range(pins):
+        pin_util.create({'pin_num': 2 + pins + n, 'name': f'in-{n}', 'direction': 'in',
+                         'rising_url': f'{stub_url}/in-{n}/on', 'falling_url': f'{stub_url}/in-{n}/off'})
+    return pin_util
+
+
+def bench_state_latency(base, requests_count):
+    session = requests.Session()
+    samples = []
+    for n in range(requests_count):
+        state = 'on' if n % 2 else 'off'
+        start = time.perf_counter()
+        session.get(f"{base}/pins/name/out-{n % 4}?state={state}").raise_for_status()
+        samples.append(time.perf_counter() - start)
+    return summarise(samples)
+
+
+def bench_list_throughput(base, requests_count, clients):
+    sessions = [requests.Session() for _ in range(clients)]
+
+    def fetch(n):
+        start = time.perf_counter()
+        sessions[n % clients].get(f"{base}/pins/").raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        samples = list(pool.map(fetch, range(requests_count)))
+    elapsed = time.perf_counter() - start
+    stats = summarise(samples)
+    stats['clients'] = clients
+    stats['requests_per_sec'] = requests_count / elapsed
+    return stats
+
+
+def bench_edge_to_webhook(sigbox, pins, edges, gap):
+    """ Time from an input edge to its rising_url/falling_url call reaching the stub """
+    gpio = sigbox.GPIO
+    samples = []
+    for n in range(edges):
+        pin = n % pins
+        pin_num = 2 + pins + pin
+        level = not gpio.input(pin_num)
+        event = [Event(), None]
+        Stub.arrivals[f"/in-{pin}/{'on' if level else 'off'}"] = event
+        start = time.monotonic()
+        gpio.set_input(pin_num, level)
+        if event[0].wait(5):
+            samples.append(event[1] - start)
+        else:
+            print(f"No webhook for edge {n} on pin {pin_num}")
+        time.sleep(gap)
+    return summarise(samples)
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_file, after_file):
+    with open(before_file) as f:
+        before = json.load(f)
+    with open(after_file) as f:
+        after = json.load(f)
+    print(f"{before.get('version')} -> {after.get('version')}")
+    for name, stats in after['scenarios'].items():
+        if name not in before['scenarios']:
+            continue
+        for key in ('p50', 'p99', 'requests_per_sec'):
+            if key in stats:
+                old, new = before['scenarios'][name][key], stats[key]
+                print(f"  {name} {key}: {old:.2f} -> {new:.2f} ({100 * (new - old) / old:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pins API and edge pipeline on a simulated GPIO')
+    parser.add_argument('-o', '--output', help='save the results to this JSON file')
+    parser.add_argument('--requests', type=int, default=500, help='requests per API scenario')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients for GET /pins/')
+    parser.add_argument('--pins', type=int, default=8, help='number of input and of output pins')
+    parser.add_argument('--edges', type=int, default=100, help='input edges to time')
+    parser.add_argument('--edge-gap', type=float, default=0.1, help='secs between input edges')
+    parser.add_argument('--verbose', action='store_true', help="show the server's own output")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two saved results')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with quiet:
+        sigbox = load_app()
+        stub_url = serve(ThreadingHTTPServer(('127.0.0.1', 0), Stub))
+        build_layout(sigbox, stub_url, args.pins)
+        base = serve(make_server('127.0.0.1', 0, sigbox.app, threaded=True, request_handler=QuietHandler))
+
+        scenarios = {
+            'state_on_off': bench_state_latency(base, args.requests),
+            'list_pins': bench_list_throughput(base, args.requests, args.clients),
+            'edge_to_webhook': bench_edge_to_webhook(sigbox, args.pins, args.edges, args.edge_gap),
+        }
+
+    print_summary('GET /pins/name/<name>?state=', scenarios['state_on_off'])
+    print_summary('GET /pins/', scenarios['list_pins'])
+    print(f"  {scenarios['list_pins']['requests_per_sec']:.0f} requests/sec with {args.clients} clients")
+    print_summary('input edge to webhook', scenarios['edge_to_webhook'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'version': version(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': sys.version.split()[0],
+                'machine': platform.machine(),
+                'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'verbose')},
+                'scenarios': scenarios,
+            }, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
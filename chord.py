@@ -0,0 +1,87 @@
+# Detect a chord of inputs held down together, such as the levers that shut the Pi down
+
+from threading import Lock, Timer, current_thread
+
+HOLD_TIME = 2.0    # secs the chord has to be held
+
+
+class ChordDetector(object):
+    """
+    Watch for every chord pin being on, with no inhibit pin on, for
+    hold_time secs, and then call on_chord(). A pin is on when it reads
+    active_level, which is low for buttons and levers that pull the pin
+    down when they are pressed or pulled.
+
+    level() is given each debounced input change, and the levels are kept
+    from those, so nothing is read from the GPIO as edges come in. Only a
+    chord pin going on to complete the chord starts the timer, so a chord
+    already made when the server starts or reloads, or when an inhibit pin
+    is let go, does nothing until it is let go and made again. Releasing a
+    chord pin or setting an inhibit pin before the timer runs out cancels it.
+    """
+    def __init__(self, on_chord, hold_time=HOLD_TIME):
+        self.on_chord = on_chord
+        self.hold_time = hold_time
+        self._pins = ()
+        self._inhibit_pins = ()
+        self._watched = frozenset()
+        self._active_level = True
+        self._levels = {}
+        self._timer = None
+        self._lock = Lock()
+
+    def configure(self, pins, inhibit_pins, read, active_level=1):
+        """ Set the chord, reading the pins' levels this once with read(pin_num) """
+        with self._lock:
+            self._cancel()
+            self._pins = tuple(pins)
+            self._inhibit_pins = tuple(inhibit_pins)
+            self._watched = frozenset(self._pins + self._inhibit_pins)
+            self._active_level = bool(active_level)
+            self._levels = {pin_num: bool(read(pin_num)) == self._active_level for pin_num in self._watched}
+
+    def level(self, pin_num, level):
+        if pin_num not in self._watched:
+            return
+        with self._lock:
+            on = bool(level) == self._active_level
+            if self._levels.get(pin_num) == on:
+                return
+            self._levels[pin_num] = on
+            self._check(arm=on and pin_num in self._pins)
+
+    @property
+    def watched(self):
+        return self._watched
+
+    @property
+    def armed(self):
+        return self._timer is not None
+
+    def _complete(self):
+        return (bool(self._pins) and all(self._levels[pin_num] for pin_num in self._pins)
+                and not any(self._levels[pin_num] for pin_num in self._inhibit_pins))
+
+    def _check(self, arm):
+        if self._complete():
+            if self._timer is None and arm:
+                print(f"Chord {self._pins} made, waiting {self.hold_time}s")
+                self._timer = Timer(self.hold_time, self._fire)
+                self._timer.daemon = True
+                self._timer.start()
+        elif self._timer is not None:
+            print(f"Chord {self._pins} broken")
+            self._cancel()
+
+    def _cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _fire(self):
+        with self._lock:
+            # A timer cancelled just as it ran out is no longer the current one
+            if current_thread() is not self._timer or not self._complete():
+                return
+            self._timer = None
+        self.on_chord()
@@ -1,26 +1,15 @@
-import requests
-import random
-import time
-
-from urllib.parse import urljoin
+from pins_client import PinsClient
 
 HOST = 'http://localhost:5000'
-PIN_ENDPOINT = 'pins/'
-PINS = urljoin(HOST, PIN_ENDPOINT)
+client = PinsClient(HOST)
 
 
 def toggle_color(color: str, state: str):
-    for pin in requests.get(PINS).json():
-        if pin['color'] == color:
-            requests.patch(urljoin(PINS, str(pin)),
-                           json={"state": state})
+    client.set_color(color, state)
 
 
 def switch_all(state: str):
-    for pin in requests.get(PINS).json():
-        if pin['state'] != state:
-            requests.patch(urljoin(PINS, str(pin['id'])),
-                           json={"state": state})
+    client.switch_all(state)
 
 
 def all_on():
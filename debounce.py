@@ -0,0 +1,105 @@
+# Software debouncing of the input pins
+
+import time
+from threading import Thread, Condition
+
+# Filtering modes
+SETTLE = 'settle'            # wait until there have been no edges for the stable time, then read the level
+INTEGRATOR = 'integrator'    # sample the level, and only change once it has agreed for the stable time
+
+INTEGRATOR_SAMPLE_PERIOD = 0.005    # secs
+
+
+class PinFilter(object):
+    """ Debounce state for one GPIO pin """
+    def __init__(self, stable_time, mode, level):
+        self.stable_time = stable_time
+        self.mode = mode
+        self.level = level
+        self.samples = max(1, round(stable_time / INTEGRATOR_SAMPLE_PERIOD))
+        self.count = self.samples if level else 0
+        self.deadline = None
+        self.first_edge = None
+        self.rejected = 0
+
+
+class Debouncer(object):
+    """
+    Turn raw GPIO edges into clean level changes.
+
+    edge() only records the time and wakes the debounce thread, so it is
+    cheap enough to call from the GPIO callback. The thread checks each
+    pin when its stable time is up, and calls on_change(pin_num, level,
+    when) only if the level has really changed, where when is the time of
+    the first edge of the burst. Pins are filtered independently, so noise
+    on one pin doesn't delay another.
+    """
+    def __init__(self, read, on_change):
+        self._read = read
+        self._on_change = on_change
+        self._filters = {}
+        self._cond = Condition()
+        Thread(target=self._run, name='debounce', daemon=True).start()
+
+    def configure(self, pin_num, stable_time, mode=SETTLE, level=None):
+        """ Set how a pin is filtered, starting from its current level """
+        if mode not in (SETTLE, INTEGRATOR):
+            raise ValueError(f"unknown debounce mode {mode}")
+        if level is None:
+            level = self._read(pin_num)
+        with self._cond:
+            self._filters[pin_num] = PinFilter(stable_time, mode, 1 if level else 0)
+
+    def remove(self, pin_num):
+        with self._cond:
+            self._filters.pop(pin_num, None)
+
+    def rejected(self, pin_num):
+        """ How many bursts of edges on a pin came to nothing """
+        f = self._filters.get(pin_num)
+        return f.rejected if f else 0
+
+    def edge(self, pin_num, when=None):
+        when = time.monotonic() if when is None else when
+        with self._cond:
+            f = self._filters.get(pin_num)
+            if f is None:
+                return
+            if f.mode == SETTLE:
+                # Every edge restarts the wait
+                f.deadline = when + f.stable_time
+            elif f.deadline is None:
+                f.deadline = when + INTEGRATOR_SAMPLE_PERIOD
+            if f.first_edge is None:
+                f.first_edge = when
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            changes = []
+            with self._cond:
+                now = time.monotonic()
+                due = [(pin_num, f) for pin_num, f in self._filters.items()
+                       if f.deadline is not None and f.deadline <= now]
+                if not due:
+                    deadlines = [f.deadline for f in self._filters.values() if f.deadline is not None]
+                    self._cond.wait(min(deadlines) - now if deadlines else None)
+                    continue
+                for pin_num, f in due:
+                    level = 1 if self._read(pin_num) else 0
+                    if f.mode == INTEGRATOR:
+                        f.count = min(f.samples, f.count + 1) if level else max(0, f.count - 1)
+                        if f.count not in (0, f.samples):
+                            # Still undecided, so keep sampling
+                            f.deadline += INTEGRATOR_SAMPLE_PERIOD
+                            continue
+                        level = 1 if f.count else 0
+                    f.deadline = None
+                    if level != f.level:
+                        f.level = level
+                        changes.append((pin_num, level, f.first_edge))
+                    else:
+                        f.rejected += 1
+                    f.first_edge = None
+            for pin_num, level, when in changes:
+                self._on_change(pin_num, level, when)
@@ -0,0 +1,110 @@
+# Background delivery of the actions triggered by input edges
+
+import time
+from collections import deque
+from queue import Queue
+from threading import Thread, Lock
+
+# What to do when a target's queue is full
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+COALESCE = 'coalesce'
+
+
+class Action(object):
+    """ One thing to do for an edge, such as calling a URL or switching video """
+    def __init__(self, target, key, description, func, *args, when=None):
+        self.time = time.monotonic() if when is None else when
+        self.target = target
+        self.key = key
+        self.description = description
+        self.func = func
+        self.args = args
+        self.attempts = 0
+
+
+class ActionDispatcher(object):
+    """
+    Deliver actions from a pool of worker threads.
+
+    Each target (a host, the video player, the serial port) has its own
+    bounded queue and only one worker at a time, so actions for a target
+    run in the order they were submitted while different targets run in
+    parallel. A failed action is retried with exponential backoff.
+
+    When a target's queue is full the policy decides what is lost:
+    drop_oldest discards the oldest queued action, drop_newest discards the
+    new one, and coalesce replaces a queued action with the same key (e.g.
+    the same lever) so only its latest edge is delivered, or discards the
+    oldest if there isn't one. Until the queue is full every action is
+    delivered, so a run of bell taps all ring.
+    """
+    def __init__(self, workers=4, queue_size=16, policy=COALESCE, retries=2, backoff=0.2):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, COALESCE):
+            raise ValueError(f"unknown dispatch policy {policy}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.retries = retries
+        self.backoff = backoff
+        self.dropped = 0
+        self._queues = {}
+        self._busy = set()
+        self._lock = Lock()
+        self._ready = Queue()
+        for n in range(workers):
+            Thread(target=self._work, name=f"dispatch-{n}", daemon=True).start()
+
+    def submit(self, action):
+        with self._lock:
+            queue = self._queues.setdefault(action.target, deque())
+            if len(queue) >= self.queue_size:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    print(f"Queue for {action.target} full, dropping {action.description}")
+                    return False
+                for n, queued in enumerate(queue):
+                    # Each bell tap is an action with the same key, so only coalesce once there's no room
+                    if self.policy == COALESCE and queued.key == action.key:
+                        print(f"Queue for {action.target} full, coalescing {queued.description} into "
+                              f"{action.description}")
+                        del queue[n]
+                        break
+                else:
+                    print(f"Queue for {action.target} full, dropping {queue[0].description}")
+                    queue.popleft()
+            queue.append(action)
+            if action.target not in self._busy:
+                self._busy.add(action.target)
+                self._ready.put(action.target)
+        return True
+
+    def depth(self):
+        """ Number of actions waiting to be delivered """
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _work(self):
+        while True:
+            target = self._ready.get()
+            with self._lock:
+                action = self._queues[target].popleft()
+            self._deliver(action)
+            with self._lock:
+                if self._queues[target]:
+                    self._ready.put(target)
+                else:
+                    self._busy.discard(target)
+
+    def _deliver(self, action):
+        while True:
+            action.attempts += 1
+            try:
+                action.func(*action.args)
+                return True
+            except Exception as e:
+                if action.attempts > self.retries:
+                    print(f"Giving up on {action.description} after {action.attempts} attempts: {e}")
+                    return False
+                delay = self.backoff * 2 ** (action.attempts - 1)
+                print(f"{action.description} failed ({e}), retrying in {delay}s")
+                time.sleep(delay)
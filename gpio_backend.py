@@ -0,0 +1,141 @@
+# Choose between the real RPi.GPIO and an in-memory simulation of it
+#
+# Set GPIO_BACKEND=sim in the environment to run the server or the light
+# shows off-Pi, e.g. for load testing:
+#     GPIO_BACKEND=sim python3 restful-pi-sigbox.py block
+
+import os
+import time
+from collections import deque
+from threading import Lock, Thread
+
+
+class SimulatedGPIO(object):
+    """
+    Stand-in for the RPi.GPIO module that keeps pin levels in memory.
+
+    It has the same functions and constants as RPi.GPIO, so it can be used
+    in its place. set_input() and inject_edges() change an input's level
+    and fire the callbacks registered with add_event_detect(), honouring the
+    edge type and bouncetime just as the real module does.
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, history=10000):
+        self.mode = None
+        self.levels = {}
+        self.directions = {}
+        # (time, pin_num, level) of every output write, newest last
+        self.history = deque(maxlen=history)
+        self._events = {}
+        self._lock = Lock()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        for pin_num in self._channels(channel):
+            self.directions[pin_num] = direction
+            if direction == self.OUT:
+                self.levels[pin_num] = self.LOW if initial is None else initial
+            elif pin_num not in self.levels:
+                self.levels[pin_num] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+
+    def input(self, channel):
+        return self.levels.get(channel, self.LOW)
+
+    def output(self, channel, value):
+        channels = self._channels(channel)
+        values = value if isinstance(value, (list, tuple)) else [value] * len(channels)
+        now = time.monotonic()
+        with self._lock:
+            for pin_num, level in zip(channels, values):
+                self.levels[pin_num] = self.HIGH if level else self.LOW
+                self.history.append((now, pin_num, self.levels[pin_num]))
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        if channel in self._events:
+            raise RuntimeError(f"Conflicting edge detection already enabled for GPIO channel {channel}")
+        self._events[channel] = [edge, [callback] if callback else [], (bouncetime or 0) / 1000, None]
+
+    def add_event_callback(self, channel, callback):
+        self._events[channel][1].append(callback)
+
+    def remove_event_detect(self, channel):
+        self._events.pop(channel, None)
+
+    def cleanup(self, channel=None):
+        for pin_num in (self._channels(channel) if channel is not None else list(self.directions)):
+            self.directions.pop(pin_num, None)
+            self._events.pop(pin_num, None)
+
+    def set_input(self, pin_num, level):
+        """ Drive an input to a level, firing its callbacks if that is an edge it is watching """
+        level = self.HIGH if level else self.LOW
+        old = self.levels.get(pin_num, self.LOW)
+        self.levels[pin_num] = level
+        event = self._events.get(pin_num)
+        if event is None or level == old:
+            return
+        edge, callbacks, bouncetime, last = event
+        if edge == self.RISING and not level or edge == self.FALLING and level:
+            return
+        now = time.monotonic()
+        if last is not None and now - last < bouncetime:
+            return
+        event[3] = now
+        for callback in callbacks:
+            callback(pin_num)
+
+    def inject_edges(self, pin_num, count, rate, final_level=None):
+        """
+        Toggle an input count times at rate edges per second, keeping to
+        the schedule rather than drifting with the time the callbacks take.
+        If final_level is given the input is left at that level.
+        """
+        start = time.monotonic()
+        for n in range(count):
+            delay = start + n / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.set_input(pin_num, not self.input(pin_num))
+        if final_level is not None:
+            self.set_input(pin_num, final_level)
+
+    def inject_edges_async(self, pin_num, count, rate, final_level=None):
+        """ inject_edges() on a background thread, which is returned """
+        thread = Thread(target=self.inject_edges, args=(pin_num, count, rate, final_level), daemon=True)
+        thread.start()
+        return thread
+
+    def _channels(self, channel):
+        return list(channel) if isinstance(channel, (list, tuple)) else [channel]
+
+
+def load(backend=None):
+    """ Return the GPIO module to use: 'rpi' for RPi.GPIO, or 'sim' for a SimulatedGPIO """
+    backend = backend or os.environ.get('GPIO_BACKEND', 'rpi')
+    if backend == 'sim':
+        print("Using simulated GPIO")
+        return SimulatedGPIO()
+    if backend != 'rpi':
+        raise ValueError(f"unknown GPIO backend {backend}")
+    import RPi.GPIO
+    return RPi.GPIO
+
+
+GPIO = load()
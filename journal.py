@@ -0,0 +1,171 @@
+# Append-only journal of output states and pin changes, to pick up from after a restart
+#
+# The file is a run of records, each a type byte, the payload length and a
+# CRC32 of the payload, then the payload:
+#     H  header, JSON {"layout": ..., "host": ...} of the layout the journal is for
+#     S  output state, the pin name, a NUL, then b'1' for on or b'0' for off
+#     C  pin config, JSON {"name": ..., "config": {...}}, with a null config for a removed pin
+# A record cut short by a power cut fails its length or CRC check, and it
+# and anything after it is ignored.
+
+import json
+import os
+import struct
+import time
+import zlib
+from threading import Condition, Lock, Thread
+
+JOURNAL_FILE = os.path.expanduser('~/.restful-pi.journal')
+FLUSH_INTERVAL = 1.0          # secs between writes, so a burst of changes costs one write
+MAX_SIZE = 64 * 1024          # bytes before the journal is compacted
+
+RECORD = struct.Struct('<cHI')
+
+
+class Journal(object):
+    """
+    The output states and API changes to pins since the layout was loaded.
+
+    Changes are held in memory and appended every FLUSH_INTERVAL, keeping
+    only the latest for each pin, so a lightshow doesn't write every frame
+    to the SD card. Once the file passes MAX_SIZE it is rewritten with just
+    the current state.
+    """
+    def __init__(self, path=JOURNAL_FILE, flush_interval=FLUSH_INTERVAL, max_size=MAX_SIZE):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.header = None
+        self.configs = {}
+        self.states = {}
+        self._pending = {}
+        self._cond = Condition()
+        self._io_lock = Lock()
+        self._thread = None
+
+    def load(self):
+        """ Replay the journal file, if there is one, into header, configs and states """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        at = 0
+        while at + RECORD.size <= len(data):
+            kind, length, crc = RECORD.unpack_from(data, at)
+            payload = data[at + RECORD.size:at + RECORD.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                print(f"Journal {self.path} is damaged after {at} bytes, ignoring the rest")
+                break
+            self._apply(kind, payload)
+            at += RECORD.size + length
+
+    def start(self, header, keep_configs=True):
+        """
+        Start journalling for a layout. Anything loaded for a different
+        layout is dropped, as are the pin configs unless keep_configs, and
+        the file is rewritten with what is kept.
+        """
+        with self._io_lock:
+            with self._cond:
+                if self.header != header:
+                    self.configs, self.states = {}, {}
+                elif not keep_configs:
+                    self.configs = {}
+                self.header = header
+                self._pending = {}
+                snapshot = self._snapshot()
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name='journal', daemon=True)
+                    self._thread.start()
+            self._rewrite(snapshot)
+
+    def state(self, name, state):
+        with self._cond:
+            if self.states.get(name) != state:
+                self.states[name] = state
+                self._pending[('S', name)] = self._state_record(name, state)
+                self._cond.notify()
+
+    def config(self, name, config):
+        """ Note a pin created or changed through the API, or removed if config is None """
+        with self._cond:
+            self.configs[name] = config
+            if config is None:
+                self.states.pop(name, None)
+            self._pending[('C', name)] = self._config_record(name, config)
+            self._cond.notify()
+
+    def flush(self):
+        """ Write any changes now, rather than waiting for the writer """
+        self._write()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+            # Let changes gather so they go in one write
+            time.sleep(self.flush_interval)
+            self._write()
+
+    def _write(self):
+        # The file is written outside _cond, so noting a change never waits for the SD card
+        with self._io_lock:
+            with self._cond:
+                records = b''.join(self._pending.values())
+                self._pending = {}
+            if not records:
+                return
+            try:
+                with open(self.path, 'ab') as f:
+                    f.write(records)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    size = f.tell()
+            except OSError as e:
+                print(f"Can't write journal {self.path}: {e}")
+                return
+            if size > self.max_size:
+                with self._cond:
+                    snapshot = self._snapshot()
+                self._rewrite(snapshot)
+
+    def _snapshot(self):
+        """ The records for the current header, configs and states """
+        records = [self._record(b'H', json.dumps(self.header).encode())]
+        records += [self._config_record(name, config) for name, config in self.configs.items()]
+        records += [self._state_record(name, state) for name, state in self.states.items()]
+        return b''.join(records)
+
+    def _rewrite(self, snapshot):
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Can't write journal {self.path}: {e}")
+
+    def _apply(self, kind, payload):
+        if kind == b'H':
+            self.header = json.loads(payload)
+        elif kind == b'S':
+            name, state = payload.split(b'\0')
+            self.states[name.decode()] = 'on' if state == b'1' else 'off'
+        elif kind == b'C':
+            record = json.loads(payload)
+            self.configs[record['name']] = record['config']
+            if record['config'] is None:
+                self.states.pop(record['name'], None)
+
+    @staticmethod
+    def _record(kind, payload):
+        return RECORD.pack(kind, len(payload), zlib.crc32(payload)) + payload
+
+    def _state_record(self, name, state):
+        return self._record(b'S', name.encode() + b'\0' + (b'1' if state == 'on' else b'0'))
+
+    def _config_record(self, name, config):
+        return self._record(b'C', json.dumps({'name': name, 'config': config}).encode())
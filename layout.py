@@ -0,0 +1,164 @@
+# Load the pin layout for a mode from a JSON, YAML or TOML file
+#
+# A layout file looks like:
+#     {
+#         "description": "Four buttons and four LEDs",
+#         "pull_up_down": "up",
+#         "splash": "/home/pi/Pictures/Edwardian Lowdham.jpg",
+#         "shutdown_pins": [26, 19],
+#         "shutdown_inhibit_pins": [],
+#         "shutdown_active": "low",
+#         "serial_port": "/dev/rfcomm0",
+#         "serial_baudrate": 9600,
+#         "pins": [
+#             {"pin_num": 21, "name": "led1", "state": "off", "direction": "out"},
+#             {"pin_num": 26, "name": "button1", "direction": "in", "rising_url": "{host}/led1?state=on"}
+#         ]
+#     }
+# where {host} in any string is replaced by the host given on the command line.
+
+import json
+import os
+
+from pins import Pin, PIN_KEYS
+from serial_output import SERIAL_PORT, SERIAL_BAUDRATE
+
+LAYOUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'layouts')
+LAYOUT_EXTENSIONS = ('.json', '.yaml', '.yml', '.toml')
+
+# Where to look for a rising_video/falling_video given without a full path
+MEDIA_DIRS = ('', '/home/pi')
+
+LAYOUT_KEYS = ('description', 'host', 'pull_up_down', 'splash', 'shutdown_pins', 'shutdown_inhibit_pins',
+               'shutdown_active', 'serial_port', 'serial_baudrate', 'pins')
+
+
+class LayoutError(ValueError):
+    pass
+
+
+def find_layout(mode):
+    """ The file for a mode, which is either a path to a layout file or the name of one in layouts/ """
+    if os.path.isfile(mode):
+        return mode
+    for extension in LAYOUT_EXTENSIONS:
+        path = os.path.join(LAYOUT_DIR, mode + extension)
+        if os.path.isfile(path):
+            return path
+    raise LayoutError(f"No layout for mode {mode} in {LAYOUT_DIR}")
+
+
+def read_file(path):
+    """ Parse a layout file, raising LayoutError if it can't be """
+    extension = os.path.splitext(path)[1]
+    if extension in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise LayoutError(f"{path}: YAML layouts need PyYAML (pip install pyyaml)")
+        with open(path) as f:
+            try:
+                return yaml.safe_load(f)
+            except (yaml.YAMLError, ValueError) as e:
+                raise LayoutError(f"{path} isn't valid YAML: {e}")
+    if extension == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            raise LayoutError(f"{path}: TOML layouts need Python 3.11 or later")
+        with open(path, 'rb') as f:
+            try:
+                return tomllib.load(f)
+            except ValueError as e:
+                raise LayoutError(f"{path} isn't valid TOML: {e}")
+    with open(path) as f:
+        try:
+            return json.load(f)
+        except ValueError as e:
+            raise LayoutError(f"{path} isn't valid JSON: {e}")
+
+
+def resolve_media(filename):
+    """ Find a video or audio file, looking in MEDIA_DIRS for relative names """
+    for directory in MEDIA_DIRS:
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            return path
+    print(f"Can't find {filename} in {', '.join(d or '.' for d in MEDIA_DIRS)}")
+    return filename
+
+
+def fill_host(value, host):
+    if isinstance(value, str):
+        return value.replace('{host}', host)
+    return value
+
+
+def load_layout(mode, host=None):
+    """
+    Read and check the layout for a mode, filling in the host and finding
+    the media files, so it only needs to be done once at startup.
+    """
+    path = find_layout(mode)
+    layout = read_file(path)
+    if not isinstance(layout, dict):
+        raise LayoutError(f"{path} should hold a layout object")
+
+    unknown = set(layout) - set(LAYOUT_KEYS)
+    if unknown:
+        raise LayoutError(f"{path} has unknown settings {', '.join(sorted(unknown))}")
+    host = host or layout.get('host', 'http://localhost:5000/pins/name')
+    if layout.get('pull_up_down', 'up') not in ('up', 'down'):
+        raise LayoutError(f"{path}: pull_up_down should be up or down")
+
+    pins = []
+    names = set()
+    for n, pin in enumerate(layout.get('pins', [])):
+        where = f"{path} pin {n + 1}"
+        if not isinstance(pin, dict):
+            raise LayoutError(f"{where} should be an object")
+        unknown = set(pin) - set(PIN_KEYS)
+        if unknown:
+            raise LayoutError(f"{where} has unknown fields {', '.join(sorted(unknown))}")
+        if not isinstance(pin.get('pin_num'), int):
+            raise LayoutError(f"{where} needs a pin_num")
+        if not isinstance(pin.get('name'), str):
+            raise LayoutError(f"{where} needs a name")
+        if pin.get('direction') not in ('in', 'out'):
+            raise LayoutError(f"{where} needs a direction of in or out")
+        # The same checks as a pin created through the API, so a bad value can't stop the server starting
+        try:
+            Pin.check(pin)
+        except ValueError as e:
+            raise LayoutError(f"{where}: {e}")
+        if pin.get('name') in names:
+            raise LayoutError(f"{where} has the same name as another pin, {pin['name']}")
+        names.add(pin.get('name'))
+
+        pin = {key: fill_host(value, host) for key, value in pin.items()}
+        for key in ('rising_video', 'falling_video'):
+            if key in pin:
+                pin[key] = resolve_media(pin[key])
+        pins.append(pin)
+
+    for key in ('shutdown_pins', 'shutdown_inhibit_pins'):
+        if not all(isinstance(pin_num, int) for pin_num in layout.get(key, [])):
+            raise LayoutError(f"{path}: {key} should be a list of GPIO pin numbers")
+    # The level a shutdown or inhibit pin reads when its button is pressed or its lever pulled
+    if layout.get('shutdown_active', 'high') not in ('high', 'low'):
+        raise LayoutError(f"{path}: shutdown_active should be high or low")
+    if not isinstance(layout.get('serial_baudrate', SERIAL_BAUDRATE), int):
+        raise LayoutError(f"{path}: serial_baudrate should be a number")
+
+    return {
+        'path': path,
+        'host': host,
+        'pull_up_down': layout.get('pull_up_down', 'up'),
+        'splash': layout.get('splash'),
+        'shutdown_pins': list(layout.get('shutdown_pins', [])),
+        'shutdown_inhibit_pins': list(layout.get('shutdown_inhibit_pins', [])),
+        'shutdown_active': layout.get('shutdown_active', 'high'),
+        'serial_port': layout.get('serial_port', SERIAL_PORT),
+        'serial_baudrate': layout.get('serial_baudrate', SERIAL_BAUDRATE),
+        'pins': pins,
+    }
@@ -1,26 +1,18 @@
-import requests
 import random
 import time
 
-from urllib.parse import urljoin
+from pins_client import PinsClient
 
 HOST = 'http://localhost:5000'
-PIN_ENDPOINT = 'pins/'
-PINS = urljoin(HOST, PIN_ENDPOINT)
+client = PinsClient(HOST)
 
 
 def toggle_color(color: str, state: str):
-    for pin in requests.get(PINS).json():
-        if pin['color'] == color:
-            requests.patch(urljoin(PINS, str(pin)),
-                           json={"state": state})
+    client.set_color(color, state)
 
 
 def switch_all(state: str):
-    for pin in requests.get(PINS).json():
-        if pin['state'] != state:
-            requests.patch(urljoin(PINS, str(pin['id'])),
-                           json={"state": state})
+    client.switch_all(state)
 
 
 def all_on():
@@ -73,41 +65,41 @@ def on_off(period=0.5):
 
 def wave(period=0.1):
     while True:
-        pins = requests.get(PINS).json()
+        pins = client.outputs()
 
         for pin in pins:
-            requests.patch(urljoin(PINS, str(pin['id'])),
-                           json={"state": "on"})
+            client.set_state(pin['name'], 'on')
             time.sleep(period)
 
         for pin in reversed(pins):
-            requests.patch(urljoin(PINS, str(pin['id'])),
-                           json={"state": "off"})
+            client.set_state(pin['name'], 'off')
             time.sleep(period)
 
 
 def wave_rand_ex(min_time=0, max_time=0.4):
     while True:
-        for pin in requests.get(PINS).json():
-            requests.patch(urljoin(PINS, str(pin['id'])),
-                           json={"state": "on"})
+        pins = client.outputs()
+
+        for pin in pins:
+            client.set_state(pin['name'], 'on')
             time.sleep(random.uniform(min_time, max_time))
 
         for pin in reversed(pins):
-            requests.patch(urljoin(PINS, str(pin['id'])),
-                           json={"state": "off"})
+            client.set_state(pin['name'], 'off')
             time.sleep(random.uniform(min_time, max_time))
 
 
 def single_rand(period=0.1):
     while True:
-        pins = requests.get(PINS).json()
-        pin = random.choice(pins)
-        requests.patch(urljoin(PINS, str(pin['id'])),
-                       json={"state": "on"})
+        pin = random.choice(client.outputs())
+        client.set_state(pin['name'], 'on')
         time.sleep(period)
-        requests.patch(urljoin(PINS, str(pin['id'])),
-                       json={"state": "off"})
+        client.set_state(pin['name'], 'off')
+
+
+def show(pattern, run_time=20, **params):
+    """ Have the Pi play a pattern itself, which is smoother than stepping it from here """
+    return client.show(pattern, run_time, **params)
 
 
 if __name__ == '__main__':
@@ -1,32 +1,22 @@
-import requests
 import random
 import time
 
-from urllib.parse import urljoin
+from pins_client import PinsClient
 
 HOST = 'http://localhost:5000'
-PIN_ENDPOINT = 'pins/'
-PINS = urljoin(HOST, PIN_ENDPOINT)
+client = PinsClient(HOST)
 
 
 def toggle_color(color: str, state: str):
-    pins = requests.get(PINS).json()
-
-    for pin in pins:
-        if pin['color'] == color:
-            pin['state'] = state
-            requests.put(urljoin(PINS, str(pin['id'])), json=pin)
+    for pin in client.outputs(color):
+        client.update(pin['name'], state=state)
 
 
 def switch_all(state: str):
-    pins = requests.get(PINS).json()
-
-    for pin in pins:
+    for pin in client.outputs():
         # don't bother sending requests to ones in correct state
         if pin['state'] != state:
-            pin['state'] = state
-            requests.put(urljoin(PINS, str(pin['id'])),
-                         json=pin)
+            client.update(pin['name'], state=state)
 
 
 def all_on():
@@ -78,32 +68,23 @@ def on_off(period=0.5):
 
 def wave(period=0.1):
     while True:
-        pins = requests.get(PINS).json()
+        pins = client.outputs()
 
         for pin in pins:
-            pin['state'] = 'on'
-            requests.put(urljoin(PINS, str(pin['id'])),
-                         json=pin)
+            client.update(pin['name'], state='on')
             time.sleep(period)
 
         for pin in reversed(pins):
-            pin['state'] = 'off'
-            requests.put(urljoin(PINS, str(pin['id'])),
-                         json=pin)
+            client.update(pin['name'], state='off')
             time.sleep(period)
 
 
 def single_rand(period=0.1):
     while True:
-        pins = requests.get(PINS).json()
-        pin = random.choice(pins)
-        pin['state'] = 'on'
-        requests.put(urljoin(PINS, str(pin['id'])),
-                     json=pin)
+        pin = random.choice(client.outputs())
+        client.update(pin['name'], state='on')
         time.sleep(period)
-        pin['state'] = 'off'
-        requests.put(urljoin(PINS, str(pin['id'])),
-                       json=pin)
+        client.update(pin['name'], state='off')
 
 
 if __name__ == '__main__':
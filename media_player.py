@@ -0,0 +1,126 @@
+# A long-running VLC player, controlled through its remote control (rc) interface
+#
+# Starting cvlc takes seconds on a Pi, so rather than starting a new player
+# for every clip, one player is kept running with the clips already in its
+# playlist, and switching clip is a single command over a unix socket.
+
+import os
+import signal
+import socket
+import time
+from subprocess import Popen, PIPE
+from threading import Lock, Thread
+
+RC_SOCKET = '/tmp/restful-pi-vlc.sock'
+START_TIMEOUT = 10    # secs to wait for the player to start listening
+
+
+class MediaPlayer(object):
+    """
+    Play videos and audio cues through one long-lived cvlc process.
+
+    preload() puts the clips in VLC's playlist up front, so play() only
+    has to jump to them. VLC is told to stop at the end of each clip
+    rather than carry on down the playlist. If the player dies it is
+    restarted, and its playlist rebuilt, on the next play().
+    """
+    def __init__(self, socket_path=RC_SOCKET, debug=True):
+        self.socket_path = socket_path
+        self.debug = debug
+        self.active = None
+        self._playlist = []
+        self._p = None
+        self._sock = None
+        self._lock = Lock()
+
+    def preload(self, filenames):
+        with self._lock:
+            self._ensure_running()
+            for filename in filenames:
+                if filename not in self._playlist:
+                    self._send(f"enqueue file://{filename}")
+                    self._playlist.append(filename)
+
+    def play(self, filename):
+        """ Switch to a clip, unless it is the one already playing """
+        with self._lock:
+            if filename == self.active and self._p is not None and self._p.poll() is None:
+                return
+            start = time.monotonic()
+            self._ensure_running()
+            if filename in self._playlist:
+                # The rc interface numbers playlist items from 1
+                self._send(f"goto {self._playlist.index(filename) + 1}")
+            else:
+                self._send(f"add file://{filename}")
+                self._playlist.append(filename)
+            self.active = filename
+            print(f"Playing {filename} after {1000 * (time.monotonic() - start):.0f}ms")
+
+    def stop(self):
+        """ Stop the player process """
+        with self._lock:
+            if self._p is not None:
+                print(f"Killing process {self._p.pid}")
+                os.killpg(os.getpgid(self._p.pid), signal.SIGINT)
+                self._p = None
+            self._close()
+            self.active = None
+
+    def _ensure_running(self):
+        if self._p is not None and self._p.poll() is None and self._sock is not None:
+            return
+        if self._p is not None:
+            print("Lost the video player, restarting it")
+            if self._p.poll() is None:
+                os.killpg(os.getpgid(self._p.pid), signal.SIGINT)
+        self._close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        # Set a session ID (os.setsid) so the player can be killed with its children
+        cmd = ['cvlc', '--fullscreen', '--no-video-title-show', '--play-and-stop',
+               '--extraintf', 'rc', '--rc-unix', self.socket_path, '--rc-fake-tty']
+        print(cmd)
+        self._p = Popen(cmd, stdout=None if self.debug else PIPE, preexec_fn=os.setsid)
+
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            try:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.connect(self.socket_path)
+                break
+            except OSError:
+                self._close()
+                if time.monotonic() > deadline or self._p.poll() is not None:
+                    raise IOError("Video player didn't start")
+                time.sleep(0.1)
+        Thread(target=self._drain, args=(self._sock,), name='vlc-rc', daemon=True).start()
+
+        # A new player has an empty playlist, so put back the clips it had
+        playlist, self._playlist = self._playlist, []
+        for filename in playlist:
+            self._send(f"enqueue file://{filename}")
+            self._playlist.append(filename)
+
+    def _send(self, command):
+        if self.debug:
+            print(f"vlc: {command}")
+        try:
+            self._sock.sendall(command.encode() + b'\n')
+        except OSError:
+            self._close()
+            raise
+
+    def _drain(self, sock):
+        """ Read and discard the replies, so VLC never blocks writing them """
+        try:
+            while sock.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
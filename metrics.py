@@ -0,0 +1,149 @@
+# Counters and histograms for the /metrics endpoint, in Prometheus' text format
+#
+# Updates don't take a lock, so they are cheap enough for the GPIO callback
+# and the request threads. Under the GIL the worst that can happen is a
+# lost count when two threads update the same series at the same instant,
+# which doesn't matter for monitoring.
+
+import time
+from bisect import bisect_left
+from threading import RLock
+
+# Upper bounds in secs, from sub-millisec GPIO work up to slow webhooks
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Counter(object):
+    """ A count for each combination of label values """
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in list(self._values.items()):
+            yield self.name + format_labels(self.labels, label_values), value
+
+
+class Histogram(object):
+    """ How many observations fell in each bucket, with their sum and count, for each combination of label values """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            # Bucket counts, then one for values over the last bucket, the sum and the count
+            series = self._series.setdefault(label_values, [0] * (len(self.buckets) + 1) + [0.0, 0])
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def time(self, *label_values):
+        return Timer(self, label_values)
+
+    def samples(self):
+        for label_values, series in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                labels = format_labels(self.labels + ('le',), label_values + (bound,))
+                yield f'{self.name}_bucket{labels}', cumulative
+            yield self.name + '_sum' + format_labels(self.labels, label_values), series[-2]
+            yield self.name + '_count' + format_labels(self.labels, label_values), series[-1]
+
+
+class Collected(object):
+    """
+    A gauge or counter that is read when the metrics are scraped, from a
+    function returning either a number or a {label values: number} dict,
+    so things that are already counted elsewhere cost nothing extra.
+    """
+    def __init__(self, name, help, func, labels=(), type='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.type = type
+        self._func = func
+
+    def samples(self):
+        values = self._func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield self.name + format_labels(self.labels, label_values), value
+
+
+class Timer(object):
+    """ Context manager timing a block into a Histogram """
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class TimedLock(object):
+    """ A re-entrant lock that records how long each acquire had to wait """
+    def __init__(self, histogram, *label_values):
+        self._lock = RLock()
+        self._histogram = histogram
+        self._label_values = label_values
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        self._histogram.observe(time.perf_counter() - start, *self._label_values)
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def collected(self, name, help, func, labels=(), type='gauge'):
+        return self.add(Collected(name, help, func, labels, type))
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, value in metric.samples():
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
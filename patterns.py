@@ -0,0 +1,190 @@
+# Lightshow patterns compiled to a timeline of frames and played on a deadline
+#
+# A pattern is a function that yields steps of (mask, hold): which of the
+# pins should be high, as a bitmask with bit n for the nth pin, and how many
+# secs to hold them before the next step. compile_pattern() runs it up front
+# into a Timeline, so playing one is only a matter of waiting for each
+# frame's time and writing the pins that change in one GPIO.output call:
+#     timeline = compile_pattern(wave, len(pins), run_time=20, period=0.1)
+#     play(timeline, [pin['pin_num'] for pin in pins])
+
+import math
+import random
+import time
+
+from gpio_backend import GPIO
+
+
+class Timeline(object):
+    """
+    The frames of a pattern, as (offset secs, mask) in time order, and how
+    long it runs, which is when the last frame's hold ends.
+    """
+    def __init__(self, pins, frames, length):
+        self.pins = pins
+        self.frames = frames
+        self.length = length
+
+    def __len__(self):
+        return len(self.frames)
+
+
+def all_mask(pins):
+    return (1 << pins) - 1
+
+
+def strobe(pins, period=0.5):
+    """ All on, then all off """
+    yield all_mask(pins), period
+    yield 0, period
+
+
+def strobe_rand(pins, min_time=0, max_time=1.2, rand=random):
+    yield all_mask(pins), rand.uniform(min_time, max_time)
+    yield 0, rand.uniform(min_time, max_time)
+
+
+def wave(pins, period=0.1):
+    """ Turn the pins on one at a time, then off again in reverse """
+    mask = 0
+    for n in range(pins):
+        mask |= 1 << n
+        yield mask, period
+    for n in reversed(range(pins)):
+        mask &= ~(1 << n)
+        yield mask, period
+
+
+def wave_rand(pins, min_time=0, max_time=0.4, rand=random):
+    """ A wave with a random period, chosen again for each half """
+    period = rand.uniform(min_time, max_time)
+    mask = 0
+    for n in range(pins):
+        mask |= 1 << n
+        yield mask, period
+    period = rand.uniform(min_time, max_time)
+    for n in reversed(range(pins)):
+        mask &= ~(1 << n)
+        yield mask, period
+
+
+def wave_rand_ex(pins, min_time=0, max_time=0.4, rand=random):
+    """ A wave with a random time for every step """
+    mask = 0
+    for n in range(pins):
+        mask |= 1 << n
+        yield mask, rand.uniform(min_time, max_time)
+    for n in reversed(range(pins)):
+        mask &= ~(1 << n)
+        yield mask, rand.uniform(min_time, max_time)
+
+
+def rainbow(pins, period=0.5, groups=None):
+    """ Light each group of pins in turn, as a list of masks, or each pin on its own """
+    for mask in groups or [1 << n for n in range(pins)]:
+        yield mask, period
+
+
+def single_rand(pins, period=0.1, rand=random):
+    """ Light one pin at random """
+    yield 1 << rand.randrange(pins), period
+
+
+PATTERNS = {
+    'rainbow': rainbow,
+    'single_rand': single_rand,
+    'strobe': strobe,
+    'strobe_rand': strobe_rand,
+    'wave': wave,
+    'wave_rand': wave_rand,
+    'wave_rand_ex': wave_rand_ex,
+}
+
+
+def compile_pattern(pattern, pins, run_time=None, max_frames=None, **params):
+    """
+    Run a pattern into a Timeline for this many pins. It is repeated for as
+    long as it takes to fill run_time secs, always finishing the repeat it
+    is in, or played once if there's no run_time. Steps that don't change
+    any pin just lengthen the frame before them, but still count towards
+    max_frames, so a pattern of tiny holds can't run on for ever.
+    """
+    frames = []
+    steps = 0
+    at = 0
+    mask = None
+    while True:
+        for step_mask, hold in pattern(pins, **params):
+            if not isinstance(step_mask, int):
+                raise ValueError("pattern steps need a mask of the pins to light")
+            if not (math.isfinite(hold) and hold >= 0):
+                raise ValueError("pattern steps need a hold of 0 or more secs")
+            steps += 1
+            if max_frames is not None and steps > max_frames:
+                raise ValueError(f"pattern has more than {max_frames} steps")
+            if step_mask != mask:
+                frames.append((at, step_mask))
+                mask = step_mask
+            at += hold
+        if run_time is None or at >= run_time or at == 0:
+            break
+    return Timeline(pins, frames, at)
+
+
+def wait_until(deadline, stop=None):
+    """ Sleep until the deadline on the monotonic clock, or until stop is set. True if stopped """
+    delay = deadline - time.monotonic()
+    if stop is not None:
+        return stop.wait(max(delay, 0))
+    if delay > 0:
+        time.sleep(delay)
+    return False
+
+
+def play(timeline, pin_nums, start=None, stop=None, levels=None, output=None):
+    """
+    Play a Timeline on the GPIO pins, the nth pin of the timeline being
+    pin_nums[n]. Each frame is due at start + its offset, so a late wake-up
+    doesn't push back the frames after it, and if playback falls behind,
+    frames whose time has already passed are merged into the latest one.
+
+    levels is the mask the pins are at now, if known, so that only pins
+    that change are written. Returns the time the timeline ended, to start
+    the next one from without a gap, and the mask the pins were left at.
+    Stops early if the stop Event is set. The pins are written with
+    output(channels, values), by default GPIO.output.
+    """
+    output = output or GPIO.output
+    start = time.monotonic() if start is None else start
+    frames = timeline.frames
+    n = 0
+    while n < len(frames):
+        if wait_until(start + frames[n][0], stop):
+            return time.monotonic(), levels
+        # Catch up to the latest frame that is already due
+        now = time.monotonic()
+        while n + 1 < len(frames) and start + frames[n + 1][0] <= now:
+            n += 1
+        mask = frames[n][1]
+        changed = all_mask(timeline.pins) if levels is None else mask ^ levels
+        channels, values = [], []
+        for i, pin_num in enumerate(pin_nums):
+            if changed >> i & 1:
+                channels.append(pin_num)
+                values.append(GPIO.HIGH if mask >> i & 1 else GPIO.LOW)
+        if channels:
+            output(channels, values)
+        levels = mask
+        n += 1
+    end = start + timeline.length
+    if wait_until(end, stop):
+        return time.monotonic(), levels
+    return end, levels
+
+
+def play_forever(pattern, pin_nums, chunk=60, **params):
+    """ Play a pattern until interrupted, compiling chunk secs at a time so random patterns keep changing """
+    start, levels = None, None
+    while True:
+        timeline = compile_pattern(pattern, len(pin_nums), chunk, **params)
+        start, levels = play(timeline, pin_nums, start, levels=levels)
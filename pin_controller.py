@@ -1,6 +1,5 @@
-import RPi.GPIO as GPIO
-import random
-import time
+from gpio_backend import GPIO
+import patterns
 
 pins = [{'pin_num': 23, 'color': 'red'},
         {'pin_num': 24, 'color': 'yellow'},
@@ -15,18 +14,18 @@ pins = [{'pin_num': 23, 'color': 'red'},
 GPIO.setmode(GPIO.BCM)  # use GPIO numbering, not generic
 GPIO.setwarnings(False)
 
+pin_nums = [pin['pin_num'] for pin in pins]
+
 # setup all pins based on above configuration
-for pin in pins:
-    GPIO.setup(pin['pin_num'], GPIO.OUT, initial=GPIO.LOW)
+GPIO.setup(pin_nums, GPIO.OUT, initial=GPIO.LOW)
 
 
 def toggle_color(color: str, state: str):
-    for pin in pins:
-        if pin['color'] == color:
-            if state == 'on':
-                GPIO.output(pin['pin_num'], GPIO.HIGH)
-            elif state == 'off':
-                GPIO.output(pin['pin_num'], GPIO.LOW)
+    color_pins = [pin['pin_num'] for pin in pins if pin['color'] == color]
+    if state == 'on':
+        GPIO.output(color_pins, GPIO.HIGH)
+    elif state == 'off':
+        GPIO.output(color_pins, GPIO.LOW)
 
 
 def color_on(color: str):
@@ -38,13 +37,11 @@ def color_off(color: str):
 
 
 def all_on():
-    for pin in pins:
-        GPIO.output(pin['pin_num'], GPIO.HIGH)
+    GPIO.output(pin_nums, GPIO.HIGH)
 
 
 def all_off():
-    for pin in pins:
-        GPIO.output(pin['pin_num'], GPIO.LOW)
+    GPIO.output(pin_nums, GPIO.LOW)
 
 
 def pin_on(pin_num: int):
@@ -56,51 +53,20 @@ def pin_off(pin_num: int):
 
 
 def strobe_reg(period=0.5):
-    while True:
-        all_on()
-        time.sleep(period)
-        all_off()
-        time.sleep(period)
+    patterns.play_forever(patterns.strobe, pin_nums, period=period)
 
 
 def strobe_rand(min_time=0, max_time=1.2):
-    while True:
-        all_on()
-        time.sleep(random.uniform(min_time, max_time))
-        all_off()
-        time.sleep(random.uniform(min_time, max_time))
+    patterns.play_forever(patterns.strobe_rand, pin_nums, min_time=min_time, max_time=max_time)
 
 
 def wave_reg(period=0.1):
-    while True:
-        for pin in pins:
-            GPIO.output(pin['pin_num'], GPIO.HIGH)
-            time.sleep(period)
-
-        for pin in reversed(pins):
-            GPIO.output(pin['pin_num'], GPIO.LOW)
-            time.sleep(period)
+    patterns.play_forever(patterns.wave, pin_nums, period=period)
 
 
 def wave_rand(min_time=0, max_time=0.4):
-    while True:
-        period = random.uniform(min_time, max_time)
-        for pin in pins:
-            GPIO.output(pin['pin_num'], GPIO.HIGH)
-            time.sleep(period)
-
-        period = random.uniform(min_time, max_time)
-        for pin in reversed(pins):
-            GPIO.output(pin['pin_num'], GPIO.LOW)
-            time.sleep(period)
+    patterns.play_forever(patterns.wave_rand, pin_nums, min_time=min_time, max_time=max_time)
 
 
 def wave_rand_ex(min_time=0, max_time=0.4):
-    while True:
-        for pin in pins:
-            GPIO.output(pin['pin_num'], GPIO.HIGH)
-            time.sleep(random.uniform(min_time, max_time))
-
-        for pin in reversed(pins):
-            GPIO.output(pin['pin_num'], GPIO.LOW)
-            time.sleep(random.uniform(min_time, max_time))
+    patterns.play_forever(patterns.wave_rand_ex, pin_nums, min_time=min_time, max_time=max_time)
@@ -0,0 +1,107 @@
+# Log of pin state changes for clients to follow
+
+import json
+import os
+import time
+from collections import deque
+from threading import Condition
+
+
+class PinEvents(object):
+    """
+    Recent pin state changes, numbered in sequence.
+
+    The sequence number doubles as a version for the whole set of pins,
+    and each pin keeps the number of its latest change as its own version.
+    A copy of each pin is kept in pins as it was published, in creation
+    order, for requests to read without taking any of the pin locks. The
+    copy goes in before seq moves on, so anyone who has read seq will find
+    at least that version of every pin there.
+
+    publish() is called whenever a pin changes. Followers ask for the
+    events after the last sequence number they saw, so a client that
+    reconnects can carry on where it left off as long as its events are
+    still in the buffer. Listeners are also called with each pin and state
+    as it is published.
+
+    seq starts again from 0 whenever the server restarts, so the versions
+    and event ids given to clients carry an epoch picked at random for
+    each run, and anything from another run is treated as unknown.
+    """
+    def __init__(self, size=1000):
+        self.seq = 0
+        self.epoch = os.urandom(4).hex()
+        self.pins = {}
+        self.removed = {}
+        self.listeners = []
+        self._events = deque(maxlen=size)
+        self._cond = Condition()
+
+    def publish(self, pin, state=None):
+        """ Record a change to a pin, which also becomes the pin's version """
+        with self._cond:
+            seq = self.seq + 1
+            pin.version = seq
+            if state == 'removed':
+                self.pins.pop(pin.id, None)
+                self.removed[pin.id] = seq
+            else:
+                self.pins[pin.id] = pin.as_dict()
+            self.seq = seq
+            self._events.append({
+                'seq': seq,
+                'time': time.monotonic(),
+                'id': pin.id,
+                'name': pin.name,
+                'state': pin.state if state is None else state,
+            })
+            self._cond.notify_all()
+        for listener in self.listeners:
+            listener(pin, state)
+
+    def pin(self, id):
+        """ The pin as it was last published, or None if there's no such pin """
+        return self.pins.get(id)
+
+    def all(self):
+        return list(self.pins.values())
+
+    def version(self, seq=None):
+        """ The version for seq, by default the latest, as given to clients """
+        return f"{self.epoch}.{self.seq if seq is None else seq}"
+
+    def parse_version(self, version):
+        """ The seq of a version from version(), or None if it isn't one of this run's """
+        epoch, _, seq = (version or '').partition('.')
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self.seq:
+            return None
+        return int(seq)
+
+    def removed_since(self, seq):
+        """ The ids of the pins removed after seq """
+        with self._cond:
+            return [id for id, removed in self.removed.items() if removed > seq]
+
+    def since(self, seq):
+        """
+        Events after seq, or None if some of them have already been
+        dropped from the buffer, or seq isn't one of ours (say from before
+        the server restarted) so the caller needs a fresh snapshot.
+        """
+        with self._cond:
+            if seq > self.seq or (not self._events and seq != self.seq):
+                return None
+            if self._events and seq < self._events[0]['seq'] - 1:
+                return None
+            return [event for event in self._events if event['seq'] > seq]
+
+    def wait(self, seq, timeout):
+        """ Wait until there is an event after seq, or the timeout runs out """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.seq > seq, timeout)
+
+
+def sse(event, data, id=None):
+    """ Format a Server-Sent Event """
+    message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return f"id: {id}\n{message}" if id is not None else message
@@ -0,0 +1,94 @@
+# A configured pin, with its fields checked once when it is created or changed
+#
+# Pins have a fixed set of fields, held in slots rather than a dict, so a
+# pin can't pick up stray keys from a request. Anything an input does on an
+# edge is worked out when the pin is configured and kept in rising and
+# falling, so handling an edge is just running down a list.
+
+from debounce import SETTLE, INTEGRATOR
+
+PIN_KEYS = ('pin_num', 'color', 'name', 'state', 'direction', 'debounce', 'debounce_mode',
+            'rising_url', 'falling_url', 'rising_video', 'falling_video', 'rising_serial', 'falling_serial')
+
+PIN_STATES = ('on', 'off', 'pulse', 'pulse01')
+
+# Pin fields that give something to do when an input changes
+EDGE_ACTION_KEYS = ('rising_url', 'falling_url', 'rising_video', 'falling_video', 'rising_serial', 'falling_serial')
+
+# Fields the server keeps itself, which are ignored if a client sends them back
+READONLY_KEYS = ('id', 'version', 'pulses_pending')
+
+STRING_KEYS = ('color', 'name') + EDGE_ACTION_KEYS
+
+
+class Pin(object):
+    """
+    One logical pin on a GPIO pin. Fields that aren't set are None, and
+    are left out of as_dict().
+
+    rising and falling are the actions for each edge, as tuples of
+    (target, key, description, func, arg) for the dispatcher. They are
+    filled in by whoever owns the pin, as they depend on where URLs,
+    videos and serial strings are sent.
+    """
+    __slots__ = READONLY_KEYS + PIN_KEYS + ('rising', 'falling')
+
+    def __init__(self, data):
+        self.check(data)
+        for key in ('pin_num', 'direction'):
+            if data.get(key) is None:
+                raise ValueError(f"pin needs a {key}")
+        for key in self.__slots__:
+            setattr(self, key, None)
+        self.rising = self.falling = ()
+        self.update(data)
+
+    @staticmethod
+    def check(data, pin=None):
+        """ Raise ValueError if data isn't a valid pin, or valid changes to pin """
+        if not isinstance(data, dict):
+            raise ValueError("pin should be an object")
+        unknown = set(data) - set(PIN_KEYS) - set(READONLY_KEYS)
+        if unknown:
+            raise ValueError(f"pin has unknown fields {', '.join(sorted(unknown))}")
+        if 'pin_num' in data and (not isinstance(data['pin_num'], int) or isinstance(data['pin_num'], bool)
+                                  or data['pin_num'] < 0):
+            raise ValueError("pin_num should be a GPIO pin number")
+        if 'direction' in data and data['direction'] not in ('in', 'out'):
+            raise ValueError("direction should be in or out")
+        if pin is not None and data.get('direction', pin.direction) != pin.direction:
+            raise ValueError("direction can't be changed, remove the pin and create it again")
+        states = PIN_STATES if pin is not None else ('on', 'off')
+        if data.get('state') not in (None,) + states:
+            raise ValueError(f"state should be {', '.join(states[:-1])} or {states[-1]}")
+        for key in STRING_KEYS:
+            if data.get(key) is not None and not isinstance(data[key], str):
+                raise ValueError(f"{key} should be a string")
+        if data.get('debounce_mode') not in (None, SETTLE, INTEGRATOR):
+            raise ValueError(f"debounce_mode should be {SETTLE} or {INTEGRATOR}")
+        debounce = data.get('debounce')
+        if debounce is not None and (not isinstance(debounce, int) or isinstance(debounce, bool) or debounce < 0):
+            raise ValueError("debounce should be a number of millisecs")
+
+    def update(self, data):
+        """ Set the fields in checked data. A field given as None is unset """
+        for key in PIN_KEYS:
+            if key in data:
+                setattr(self, key, data[key])
+
+    @property
+    def has_actions(self):
+        return bool(self.rising or self.falling)
+
+    def config(self):
+        """ The fields set from the layout or the API, but not the state """
+        return {key: getattr(self, key) for key in PIN_KEYS
+                if key != 'state' and getattr(self, key) is not None}
+
+    def as_dict(self):
+        values = {key: getattr(self, key) for key in ('id',) + PIN_KEYS + ('version', 'pulses_pending')}
+        return {key: value for key, value in values.items() if value is not None}
+
+    def __repr__(self):
+        return f"Pin({self.as_dict()})"
+
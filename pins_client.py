@@ -0,0 +1,290 @@
+# Client for the restful-pi pins API
+#
+#     client = PinsClient('http://localhost:5000')
+#     client.set_state('led1', 'on')
+#     client.set_color('red', 'off')      # one PATCH for all the red pins
+#
+# or with asyncio, which needs aiohttp:
+#     async with AsyncPinsClient('http://localhost:5000') as client:
+#         await client.set_state('led1', 'on')
+#
+# Both keep their connection to the server open between calls, and keep a
+# copy of the pin list that is only fetched again when the server says it
+# has changed, so looking pins up by name doesn't cost a request each time.
+
+import fnmatch
+
+import requests
+
+HOST = 'http://localhost:5000'
+TIMEOUT = (1.0, 5.0)    # secs to connect, and to wait for a reply
+
+
+def takes_batches(status, body):
+    """
+    False if a reply to PATCH /pins/ means the server doesn't do batches,
+    rather than that it turned this one down. Our server says why in a
+    JSON message when a batch names a pin it doesn't have.
+    """
+    return not (status == 405 or (status == 404 and not (isinstance(body, dict) and 'message' in body)))
+
+
+class PinCache(object):
+    """ The client's copy of the pin list, the ETag to revalidate it with, and a name to pin map """
+    def __init__(self):
+        self.pins = []
+        self.etag = None
+        self.by_name = {}
+
+    def store(self, pins, etag):
+        self.pins = pins
+        self.etag = etag
+        self.by_name = {pin['name']: pin for pin in pins if pin.get('name')}
+
+    def update(self, pin):
+        """ Note a pin the server sent back after changing it """
+        cached = self.by_name.get(pin.get('name'))
+        if cached is not None:
+            cached.update(pin)
+
+    def headers(self):
+        return {'If-None-Match': self.etag} if self.etag else {}
+
+    def names(self, change):
+        """ The names of the output pins a batch change would select, for servers that can't do batches """
+        if change.get('name') is not None:
+            return [change['name']]
+        outputs = [pin for pin in self.pins if pin.get('direction') == 'out']
+        if change.get('color') is not None:
+            return [pin['name'] for pin in outputs if pin.get('color') == change['color']]
+        return [pin['name'] for pin in outputs if fnmatch.fnmatchcase(pin.get('name') or '', change['match'])]
+
+
+class PinsClient(object):
+    """
+    Set and read pins over one keep-alive session.
+
+    Changes to several pins go in one PATCH to /pins/ when the server
+    supports it, and are sent pin by pin when it doesn't.
+    """
+    def __init__(self, host=HOST, timeout=TIMEOUT):
+        self.base = host.rstrip('/') + '/pins/'
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.cache = PinCache()
+        self.batches = None     # whether the server takes batches, once we know
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def pins(self):
+        """ All the pins, from the cache if the server says they haven't changed """
+        r = self.session.get(self.base, headers=self.cache.headers(), timeout=self.timeout)
+        if r.status_code == 304:
+            return self.cache.pins
+        r.raise_for_status()
+        self.cache.store(r.json(), r.headers.get('ETag'))
+        return self.cache.pins
+
+    def outputs(self, color=None):
+        return [pin for pin in self.pins()
+                if pin.get('direction') == 'out' and (color is None or pin.get('color') == color)]
+
+    def pin_id(self, name):
+        if name not in self.cache.by_name:
+            self.pins()
+        if name not in self.cache.by_name:
+            raise KeyError(f"No pin called {name}")
+        return self.cache.by_name[name]['id']
+
+    def pin(self, name):
+        return self._pin_request('GET', name)
+
+    def set_state(self, name, state, wait=False):
+        """ Set a pin on, off, pulse or pulse01. With wait, a pulse is finished before this returns """
+        params = {'state': state, 'wait': 'true'} if wait else {'state': state}
+        pin = self._pin_request('GET', name, params=params)
+        self.cache.update(pin)
+        return pin
+
+    def update(self, name, **fields):
+        """ PUT new values for some of a pin's fields """
+        pin = self._pin_request('PUT', name, json=fields)
+        self.cache.update(pin)
+        return pin
+
+    def set_states(self, states):
+        """ Set several pins from a {name: state} dict """
+        return self.batch([{'name': name, 'state': state} for name, state in states.items()])
+
+    def set_color(self, color, state):
+        return self.batch([{'color': color, 'state': state}])
+
+    def switch_all(self, state):
+        return self.batch([{'match': '*', 'state': state}])
+
+    def batch(self, changes):
+        """ Make a list of PATCH /pins/ changes, returning the pins changed """
+        if self.batches is not False:
+            r = self.session.patch(self.base, json=changes, timeout=self.timeout)
+            try:
+                body = r.json() if r.status_code == 404 else None
+            except ValueError:
+                body = None
+            if takes_batches(r.status_code, body):
+                r.raise_for_status()
+                self.batches = True
+                pins = r.json()
+                for pin in pins:
+                    self.cache.update(pin)
+                return pins
+            self.batches = False
+
+        self.pins()
+        states = {}
+        for change in changes:
+            for name in self.cache.names(change):
+                states[name] = change['state']
+        return [self.set_state(name, state) for name, state in states.items()]
+
+    def show(self, pattern, run_time=20, **params):
+        """ Have the server play a lightshow pattern itself """
+        return self._request('POST', 'shows', json={'pattern': pattern, 'params': params, 'run_time': run_time})
+
+    def stop_show(self, id):
+        return self._request('DELETE', f'shows/{id}')
+
+    def _pin_request(self, method, name, **kwargs):
+        """ A request to a pin by name, fetching the pins again once if its id has gone, as a reload gives new ids """
+        try:
+            return self._request(method, str(self.pin_id(name)), **kwargs)
+        except requests.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+        self.pins()
+        return self._request(method, str(self.pin_id(name)), **kwargs)
+
+    def _request(self, method, path, **kwargs):
+        r = self.session.request(method, self.base + path, timeout=self.timeout, **kwargs)
+        r.raise_for_status()
+        return r.json()
+
+
+class AsyncPinsClient(object):
+    """ PinsClient for asyncio, on an aiohttp session """
+    def __init__(self, host=HOST, timeout=TIMEOUT):
+        import aiohttp
+        self._aiohttp = aiohttp
+        self.base = host.rstrip('/') + '/pins/'
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.session = None
+        self.cache = PinCache()
+        self.batches = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def pins(self):
+        async with self._session().get(self.base, headers=self.cache.headers()) as r:
+            if r.status == 304:
+                return self.cache.pins
+            r.raise_for_status()
+            self.cache.store(await r.json(), r.headers.get('ETag'))
+        return self.cache.pins
+
+    async def outputs(self, color=None):
+        return [pin for pin in await self.pins()
+                if pin.get('direction') == 'out' and (color is None or pin.get('color') == color)]
+
+    async def pin_id(self, name):
+        if name not in self.cache.by_name:
+            await self.pins()
+        if name not in self.cache.by_name:
+            raise KeyError(f"No pin called {name}")
+        return self.cache.by_name[name]['id']
+
+    async def pin(self, name):
+        return await self._pin_request('GET', name)
+
+    async def set_state(self, name, state, wait=False):
+        params = {'state': state, 'wait': 'true'} if wait else {'state': state}
+        pin = await self._pin_request('GET', name, params=params)
+        self.cache.update(pin)
+        return pin
+
+    async def update(self, name, **fields):
+        pin = await self._pin_request('PUT', name, json=fields)
+        self.cache.update(pin)
+        return pin
+
+    async def set_states(self, states):
+        return await self.batch([{'name': name, 'state': state} for name, state in states.items()])
+
+    async def set_color(self, color, state):
+        return await self.batch([{'color': color, 'state': state}])
+
+    async def switch_all(self, state):
+        return await self.batch([{'match': '*', 'state': state}])
+
+    async def batch(self, changes):
+        if self.batches is not False:
+            async with self._session().patch(self.base, json=changes) as r:
+                try:
+                    body = await r.json(content_type=None) if r.status == 404 else None
+                except ValueError:
+                    body = None
+                if takes_batches(r.status, body):
+                    r.raise_for_status()
+                    self.batches = True
+                    pins = await r.json()
+                    for pin in pins:
+                        self.cache.update(pin)
+                    return pins
+            self.batches = False
+
+        await self.pins()
+        states = {}
+        for change in changes:
+            for name in self.cache.names(change):
+                states[name] = change['state']
+        return [await self.set_state(name, state) for name, state in states.items()]
+
+    async def show(self, pattern, run_time=20, **params):
+        return await self._request('POST', 'shows', json={'pattern': pattern, 'params': params, 'run_time': run_time})
+
+    async def stop_show(self, id):
+        return await self._request('DELETE', f'shows/{id}')
+
+    def _session(self):
+        # aiohttp sessions have to be made inside the event loop
+        if self.session is None:
+            self.session = self._aiohttp.ClientSession(timeout=self.timeout)
+        return self.session
+
+    async def _pin_request(self, method, name, **kwargs):
+        try:
+            return await self._request(method, str(await self.pin_id(name)), **kwargs)
+        except self._aiohttp.ClientResponseError as e:
+            if e.status != 404:
+                raise
+        await self.pins()
+        return await self._request(method, str(await self.pin_id(name)), **kwargs)
+
+    async def _request(self, method, path, **kwargs):
+        async with self._session().request(method, self.base + path, **kwargs) as r:
+            r.raise_for_status()
+            return await r.json()
@@ -2,14 +2,31 @@
 
 # Raspberry Pi GPIO-controlled REST API
 
-from flask import Flask, request
-from flask_restx import Api, Resource, fields, reqparse
-import RPi.GPIO as GPIO
-from subprocess import Popen, PIPE
+from flask import Flask, Response, g, request
+from flask_restx import Api, Resource, fields, inputs, marshal, reqparse
+from werkzeug.exceptions import HTTPException
+from gpio_backend import GPIO
+from subprocess import Popen
 import requests
-import serial
-import os, sys, signal, time
-from threading import Thread, Lock
+from requests.adapters import HTTPAdapter
+import fnmatch, heapq, inspect, itertools, json, os, sys, signal, time
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager, nullcontext
+from queue import Queue, Full
+from threading import Thread, Lock, BoundedSemaphore, Condition, Event
+from urllib.parse import urlparse
+from dispatcher import Action, ActionDispatcher, COALESCE
+from debounce import Debouncer, SETTLE
+from pin_events import PinEvents, sse
+from layout import load_layout, resolve_media, LayoutError, PIN_KEYS
+import pins
+from pins import PIN_STATES
+from media_player import MediaPlayer
+from chord import ChordDetector
+from journal import Journal, JOURNAL_FILE
+from metrics import Registry, TimedLock
+import patterns
+from serial_output import SerialOutput, SERIAL_PORT, SERIAL_BAUDRATE
 
 app = Flask(__name__)
 api = Api(app,
@@ -19,9 +36,46 @@ api = Api(app,
           doc='/docs')
 
 ns = api.namespace('pins', description='Pin related operations')
+admin_ns = api.namespace('admin', description='Server administration')
+
+# Serve the API with waitress, a production WSGI server, or 'flask' for Flask's development server
+SERVER = os.environ.get('RESTFUL_PI_SERVER', 'waitress')
+PORT = 5000
+# Requests handled at once. Each /pins/events stream keeps one of these busy, so only
+# MAX_EVENT_STREAMS may be open at a time, leaving the rest for the API and the levers
+SERVER_THREADS = 16
+SERVER_CONNECTIONS = 200
+MAX_EVENT_STREAMS = 4
 
 GPIO_BOUNCE_TIME = 10    # millisecs
 
+# How long the shutdown pins have to be held together, and what to run then
+SHUTDOWN_HOLD_TIME = 2.0    # secs
+SHUTDOWN_COMMAND = "sudo halt"
+
+# Software debounce: an input must be steady this long before a change is acted on
+DEBOUNCE_TIME = 50       # millisecs, unless the pin sets 'debounce'
+DEBOUNCE_MODE = SETTLE   # or 'integrator', unless the pin sets 'debounce_mode'
+
+# Input edges waiting to be processed, and the delivery of the actions they trigger
+EDGE_QUEUE_SIZE = 64
+DISPATCH_WORKERS = 4
+DISPATCH_QUEUE_SIZE = 16      # per target
+DISPATCH_POLICY = COALESCE    # or DROP_OLDEST / DROP_NEWEST
+DISPATCH_RETRIES = 2
+DISPATCH_BACKOFF = 0.2        # secs, doubled on each retry
+# State changes kept for /pins/events clients that reconnect, and how often to
+# send them a keepalive when nothing is happening
+EVENT_BUFFER_SIZE = 1000
+EVENT_KEEPALIVE = 5           # secs. A closed stream is only noticed when a keepalive can't be sent
+
+# Whether to leave fields that aren't set out of pin replies, if the request doesn't say with ?skip_none=
+SKIP_NONE = False
+
+URL_TIMEOUT = (1.0, 2.0)      # connect and read timeouts, secs
+HTTP_POOL_HOSTS = 4           # hosts to keep connections open to
+HTTP_POOL_SIZE = DISPATCH_WORKERS   # connections kept alive per host
+
 pin_model = api.model('pins', {
     'id': fields.Integer(readonly=True, description='The pin unique identifier'),
     'pin_num': fields.Integer(required=True, description='GPIO pin associated with this endpoint'),
@@ -35,233 +89,1287 @@ pin_model = api.model('pins', {
     'falling_video': fields.String(required=False, description='video to play on falling edge of input'),
     'rising_serial': fields.String(required=False, description='string to send on rising edge of input'),
     'falling_serial': fields.String(required=False, description='string to send on falling edge of input'),
+    'debounce': fields.Integer(required=False, description='millisecs an input must be steady before it changes'),
+    'debounce_mode': fields.String(required=False, description='settle (default) or integrator'),
+    'version': fields.Integer(readonly=True, description='pins version when this pin last changed'),
+    'pulses_pending': fields.Integer(readonly=True, description='pulses queued but not yet finished on this output'),
+})
+
+batch_change_model = api.model('pin_changes', {
+    'id': fields.Integer(required=False, description='change the pin with this identifier'),
+    'name': fields.String(required=False, description='or the pin with this function name'),
+    'color': fields.String(required=False, description='or all output pins of this color'),
+    'match': fields.String(required=False, description='or all output pins whose names match this pattern, e.g. lh-*'),
+    'state': fields.String(required=True, description='on, off, pulse or pulse01'),
 })
 
+bells_model = api.model('bells', {
+    'code': fields.String(required=False, description='bell code such as 3-1 or 2-2-1'),
+    'pattern': fields.List(fields.List(fields.Float), required=False,
+                           description='list of [on, off] durations of 0 to 10 secs, used if there is no code'),
+    'state': fields.String(required=False, description='pulse (default) or pulse01 for an active low output'),
+})
+
+sequence_model = api.model('sequences', {
+    'id': fields.Integer(readonly=True, description='The sequence unique identifier'),
+    'name': fields.String(readonly=True, description='name of the pin being rung'),
+    'status': fields.String(readonly=True, description='queued, playing, done or cancelled'),
+    'steps': fields.List(fields.List(fields.Float), readonly=True, description='[on, off] durations in seconds'),
+    'beats_played': fields.Integer(readonly=True, description='beats rung so far'),
+    'starts_in': fields.Float(readonly=True, description='seconds until the first beat'),
+    'ends_in': fields.Float(readonly=True, description='seconds until the sequence has finished'),
+})
+
+show_request_model = api.model('show_request', {
+    'pattern': fields.String(required=False, description='name of a pattern from /pins/patterns'),
+    'params': fields.Raw(required=False, description='parameters for the pattern, such as {"period": 0.1}'),
+    'steps': fields.Raw(required=False,
+                        description='a pattern of your own, as a list of {"on": [pin names], "hold": secs}'),
+    'pins': fields.List(fields.String, required=False, description='names of the pins to play it on'),
+    'color': fields.String(required=False, description='play it on the pins of this color'),
+    'match': fields.String(required=False, description="play it on the pins with names matching, e.g. 'lh-*'"),
+    'run_time': fields.Float(required=False, description='seconds to play for, to the end of the repeat'),
+})
+
+show_model = api.model('shows', {
+    'id': fields.Integer(readonly=True, description='The show unique identifier'),
+    'pattern': fields.String(readonly=True, description='name of the pattern playing'),
+    'pins': fields.List(fields.String, readonly=True, description='names of the pins it plays on'),
+    'status': fields.String(readonly=True, description='playing, done or stopped'),
+    'frames': fields.Integer(readonly=True, description='number of changes in the timeline'),
+    'run_time': fields.Float(readonly=True, description='seconds the timeline runs for'),
+    'ends_in': fields.Float(readonly=True, description='seconds until the show has finished'),
+})
+
+pattern_model = api.model('patterns', {
+    'name': fields.String(readonly=True, description='name of the pattern'),
+    'params': fields.Raw(readonly=True, description='parameters it takes, with their defaults'),
+    'description': fields.String(readonly=True),
+})
+
+# States that can be set on an output pin
 # Duration of a bell pulse when you set the state to 'pulse'
 pulse_period = 0.15
 gap_period = 0.25
+# Pause between the groups of a bell code, e.g. the '-' in 3-1
+group_gap_period = 0.8
+# Longest pattern accepted by the bells endpoint, longest on or off time in it in secs,
+# and how many finished ones to remember
+max_sequence_steps = 64
+max_step_time = 10.0
+max_sequences_kept = 100
+# Lightshows: default and longest run time in secs, most frames, and the colours a rainbow goes through
+show_run_time = 20
+max_show_time = 3600
+max_show_frames = 100000
+# Secs to wait for a stopped show to put its pins back
+show_stop_timeout = 2.0
+rainbow_colors = ('red', 'blue', 'green', 'yellow')
+
+# Metrics for /metrics; the ones read from the running pins are added after PinUtil
+registry = Registry()
+request_seconds = registry.histogram('restful_pi_request_seconds', 'Time to handle an API request',
+                                     ('route', 'method'))
+edges_total = registry.counter('restful_pi_edges_total', 'Raw GPIO edges seen on each input', ('pin_num',))
+mutex_wait_seconds = registry.histogram('restful_pi_mutex_wait_seconds',
+                                        'Time spent waiting for the pin registry or a GPIO pin lock', ('lock',))
+webhook_seconds = registry.histogram('restful_pi_webhook_seconds', 'Time for a rising_url/falling_url call',
+                                     ('host',))
+webhook_failures_total = registry.counter('restful_pi_webhook_failures_total',
+                                          'rising_url/falling_url calls that failed, including retries', ('host',))
+video_switch_seconds = registry.histogram('restful_pi_video_switch_seconds', 'Time to switch the video player to a clip')
+
+
+def bell_code_steps(code):
+    """
+    Convert a bell code such as '3-1' or '2-2-1' into a list of
+    (on, off) durations in seconds.
+    """
+    try:
+        groups = [int(beats) for beats in code.split('-')]
+    except ValueError:
+        raise ValueError(f"bell code {code} should be numbers separated by '-'")
+    if not groups or min(groups) < 1:
+        raise ValueError(f"bell code {code} should only have groups of 1 or more beats")
+
+    steps = []
+    for beats in groups:
+        steps += [(pulse_period, gap_period)] * (beats - 1)
+        steps.append((pulse_period, group_gap_period))
+    steps[-1] = (pulse_period, gap_period)
+    return steps
+
+
+class PulseSequence(object):
+    """ A run of pulses queued on one output, which can be polled or cancelled """
+    def __init__(self, pin_num, level, rest_level, steps, on_done=None):
+        self.id = None
+        self.name = None
+        self.pin_num = pin_num
+        self.level = level
+        self.rest_level = rest_level
+        self.steps = steps
+        self.beats_played = 0
+        self.cancelled = False
+        self.done = Event()
+        self.start = self.end = None
+        self._on_done = on_done
+
+    @property
+    def status(self):
+        if self.cancelled:
+            return 'cancelled'
+        if self.done.is_set():
+            return 'done'
+        if self.start <= time.monotonic():
+            return 'playing'
+        return 'queued'
+
+    @property
+    def starts_in(self):
+        return max(0.0, self.start - time.monotonic())
+
+    @property
+    def ends_in(self):
+        if self.done.is_set():
+            return 0.0
+        return max(0.0, self.end - time.monotonic())
+
+    def finish(self):
+        if not self.done.is_set():
+            if self._on_done:
+                self._on_done()
+            self.done.set()
+
+
+class LightShow(object):
+    """ A pattern playing on a group of output pins, which can be polled or stopped """
+    def __init__(self, pattern, pins, timeline):
+        self.id = None
+        self.pattern = pattern
+        self.group = pins
+        self.timeline = timeline
+        self.stopped = False
+        self.start = None
+        self.done = Event()
+        self._stop = Event()
+
+    @property
+    def pins(self):
+        return [pin.name or pin.id for pin in self.group]
+
+    @property
+    def status(self):
+        if self.stopped:
+            return 'stopped'
+        if self.done.is_set():
+            return 'done'
+        return 'playing'
+
+    @property
+    def frames(self):
+        return len(self.timeline)
+
+    @property
+    def run_time(self):
+        return self.timeline.length
+
+    @property
+    def ends_in(self):
+        if self.done.is_set():
+            return 0.0
+        return max(0.0, self.start + self.timeline.length - time.monotonic())
+
+    def stop(self):
+        self.stopped = not self.done.is_set()
+        self._stop.set()
+        if not self.done.wait(show_stop_timeout):
+            print(f"Show {self.id} hasn't stopped after {show_stop_timeout}s")
+
+
+class OutputScheduler(object):
+    """
+    Drive output pins from a background thread so pulses don't block
+    the request thread.
+
+    Level changes are held in a heap ordered by their due time on the
+    monotonic clock. Each GPIO pin is kept busy until its last pulse and gap
+    have finished, so anything sent to the same pin plays in order, while
+    different pins run concurrently.
+    """
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._free_at = {}
+        self._thread = None
+
+    def set(self, pin_num, level):
+        """ Set a level, after any pulses still queued on this pin """
+        with self._cond:
+            now = time.monotonic()
+            start = self._free_at.get(pin_num, 0)
+            if start <= now:
+                GPIO.output(pin_num, level)
+                return
+            self._push(start, pin_num, level, None, False)
+
+    def set_many(self, levels):
+        """
+        Set several pins from a {pin_num: level} dict. Pins that are free are
+        written together in one GPIO call; the rest wait for their pulses.
+        """
+        with self._cond:
+            now = time.monotonic()
+            free = [pin_num for pin_num in levels if self._free_at.get(pin_num, 0) <= now]
+            if free:
+                GPIO.output(free, [levels[pin_num] for pin_num in free])
+            for pin_num in levels:
+                if pin_num not in free:
+                    self._push(self._free_at[pin_num], pin_num, levels[pin_num], None, False)
+
+    def pulse(self, pin_num, level, rest_level, on_done=None):
+        """
+        Queue a single pulse to level then back to rest_level.
+        The returned sequence's done Event is set once the pin is back at rest_level.
+        """
+        return self.play(PulseSequence(pin_num, level, rest_level,
+                                       [(pulse_period, gap_period)], on_done))
+
+    def play(self, sequence):
+        """ Queue every (on, off) step of a PulseSequence after anything already on its pin """
+        with self._cond:
+            at = sequence.start = max(time.monotonic(), self._free_at.get(sequence.pin_num, 0))
+            for n, (on, off) in enumerate(sequence.steps):
+                self._push(at, sequence.pin_num, sequence.level, sequence, False)
+                self._push(at + on, sequence.pin_num, sequence.rest_level, sequence,
+                           n == len(sequence.steps) - 1)
+                at += on + off
+            sequence.end = self._free_at[sequence.pin_num] = at
+        return sequence
+
+    def cancel(self, sequence):
+        """ Drop the rest of a sequence and put its pin back at rest """
+        with self._cond:
+            if sequence.cancelled or sequence.done.is_set():
+                return
+            sequence.cancelled = True
+            now = time.monotonic()
+            if sequence.start <= now:
+                GPIO.output(sequence.pin_num, sequence.rest_level)
+            self._heap = [entry for entry in self._heap if entry[4] is not sequence]
+            heapq.heapify(self._heap)
+            # The pin is free once whatever else is queued on it has played,
+            # or from now (or when the sequence was due to start) if nothing is
+            busy = [entry[4].end if entry[4] is not None else entry[0]
+                    for entry in self._heap if entry[2] == sequence.pin_num]
+            self._free_at[sequence.pin_num] = max(busy, default=min(sequence.start, now))
+        sequence.finish()
+
+    def _push(self, due, pin_num, level, sequence, last):
+        heapq.heappush(self._heap, (due, next(self._seq), pin_num, level, sequence, last))
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='output-scheduler', daemon=True)
+            self._thread.start()
+        self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                due, _, pin_num, level, sequence, last = heapq.heappop(self._heap)
+                if sequence is not None and sequence.cancelled:
+                    continue
+                GPIO.output(pin_num, level)
+            if sequence is not None:
+                if level == sequence.level:
+                    sequence.beats_played += 1
+                if last:
+                    sequence.finish()
+
+
+class PinRegistry(object):
+    """
+    Index of the configured pins.
+
+    Pins are kept in creation order, and indexed by id, by name and by GPIO
+    pin number so lookups don't need to scan the whole list. Several logical
+    pins may share one GPIO pin, but names must be unique.
+    """
+    def __init__(self):
+        self._by_id = {}
+        self._by_name = {}
+        self._by_pin_num = {}
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def all(self):
+        return list(self._by_id.values())
+
+    def get(self, id):
+        return self._by_id.get(id)
+
+    def find(self, name):
+        return self._by_name.get(name)
+
+    def on_pin_num(self, pin_num):
+        return self._by_pin_num.get(pin_num, ())
+
+    def name_clash(self, name, id=None):
+        """ True if name is already used by a pin other than id """
+        other = self._by_name.get(name)
+        return other is not None and other.id != id
+
+    def add(self, pin):
+        self._by_id[pin.id] = pin
+        self._index(pin)
+
+    def remove(self, pin):
+        self._unindex(pin)
+        del self._by_id[pin.id]
+
+    def reindex(self, pin, old_name, old_pin_num):
+        """ Refresh the indexes after a pin's name or pin_num has changed """
+        if old_name == pin.name and old_pin_num == pin.pin_num:
+            return
+        self._unindex(pin, old_name, old_pin_num)
+        self._index(pin)
+
+    def _index(self, pin):
+        if pin.name is not None:
+            self._by_name[pin.name] = pin
+        self._by_pin_num[pin.pin_num] = self._by_pin_num.get(pin.pin_num, ()) + (pin,)
+
+    def _unindex(self, pin, name=None, pin_num=None):
+        name = pin.name if name is None else name
+        pin_num = pin.pin_num if pin_num is None else pin_num
+        if self._by_name.get(name) is pin:
+            del self._by_name[name]
+        others = tuple(p for p in self._by_pin_num.get(pin_num, ()) if p is not pin)
+        if others:
+            self._by_pin_num[pin_num] = others
+        else:
+            self._by_pin_num.pop(pin_num, None)
 
 
 class PinUtil(object):
     def __init__(self):
         self.counter = 0
-        self.pins = []
-        self._mutex = Lock()
+        self.pins = PinRegistry()
+        # Adding, removing, renaming or moving pins takes the registry lock;
+        # changing a pin takes the lock of the GPIO pin it is on, so edges and
+        # requests on different pins never wait on each other. When both are
+        # needed the registry lock is taken first, and GPIO pin locks are
+        # taken in pin number order. Requests read the copies in events.pins.
+        self._registry_lock = TimedLock(mutex_wait_seconds, 'registry')
+        self._pin_locks = {}
         self.debug = 1
         self.pull_up_down = GPIO.PUD_UP
         
-        # The currently playing video filename
-        self._active_vid = None
+        self.scheduler = OutputScheduler()
+        self.sequence_counter = 0
+        self.sequences = OrderedDict()
+        self._sequence_lock = Lock()
+        self.show_counter = 0
+        self.shows = OrderedDict()
+        self._show_lock = Lock()
+
+        self.dispatcher = ActionDispatcher(workers=DISPATCH_WORKERS, queue_size=DISPATCH_QUEUE_SIZE,
+                                           policy=DISPATCH_POLICY, retries=DISPATCH_RETRIES,
+                                           backoff=DISPATCH_BACKOFF)
+        # One session for all the rising_url/falling_url calls, so connections to the
+        # signalling host are kept alive rather than opened for every lever
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        self.debouncer = Debouncer(GPIO.input, self._debounced)
+        self.events = PinEvents(EVENT_BUFFER_SIZE)
+        # GPIO pins with edge detection turned on. Changing a pin's actions
+        # only holds its GPIO pin lock, and reloading only the registry lock,
+        # so the set has a lock of its own
+        self._watching = set()
+        self._watching_lock = Lock()
+        self._edges = Queue(maxsize=EDGE_QUEUE_SIZE)
+        Thread(target=self._edge_loop, name='edges', daemon=True).start()
 
-        # The process of the active video player
-        self._p = None
+        # The video player, started when there are videos to play
+        self.player = MediaPlayer(debug=self.debug)
 
-        # mser = serial.Serial('/dev/rfcomm0', 9600)  # open serial port
-        # print(ser.name)         # check which port was really used
-        #ser.write(b'hello')     # write a string
-        #ser.close()             # close port
+        # Output states and pin changes to restore after a restart, once started
+        self.journal = None
+
+        # The layout's shutdown_pins and shutdown_inhibit_pins
+        self.shutdown_chord = ChordDetector(self._shutdown, SHUTDOWN_HOLD_TIME)
+
+        # The serial port for rising_serial/falling_serial, opened when first needed
+        self.serial_port = SERIAL_PORT
+        self.serial_baudrate = SERIAL_BAUDRATE
+        self.serial = None
 
     def set_pull_up_down(self, pull_up_down):
         self.pull_up_down = pull_up_down
         print(f"Pull Up or Down = ${pull_up_down}")
 
+    def restore(self, journal, header, pins):
+        """
+        A layout's pins with the changes from the journal, if it was kept
+        for the same layout, so they can be created as they were before
+        the server restarted. A pin changed through the API takes its
+        journalled config in place of the layout's, so a field that was
+        cleared stays cleared, keeping only the layout's starting state.
+        """
+        journal.load()
+        if journal.header != header:
+            return pins
+        by_name = OrderedDict((pin['name'], dict(pin)) for pin in pins)
+        for name, config in journal.configs.items():
+            if config is None:
+                by_name.pop(name, None)
+            else:
+                state = by_name.get(name, {}).get('state')
+                by_name[name] = dict(config, state=state) if state is not None else dict(config)
+        for name, state in journal.states.items():
+            if name in by_name and by_name[name]['direction'] == 'out':
+                by_name[name]['state'] = state
+        print(f"Restored {len(journal.configs)} pin changes and {len(journal.states)} output states from {journal.path}")
+        return list(by_name.values())
+
+    def start_journal(self, journal, header, keep_configs=True):
+        """ Record output states and pin changes from now on """
+        if self.journal is None:
+            self.events.listeners.append(self._journal_state)
+        self.journal = journal
+        journal.start(header, keep_configs)
+
+    def _journal_state(self, pin, state):
+        if pin.direction == 'out' and pin.state in ('on', 'off') and pin.name is not None and state != 'removed':
+            self.journal.state(pin.name, pin.state)
+
+    def _journal_config(self, pin, old_name=None):
+        if self.journal is None:
+            return
+        if old_name is not None and old_name != pin.name:
+            self.journal.config(old_name, None)
+        if pin.name is not None:
+            self.journal.config(pin.name, pin.config())
+
+    def set_shutdown_pins(self, pins, inhibit_pins, active_level=GPIO.HIGH):
+        with self._registry_lock:
+            old = self.shutdown_chord.watched
+            self.shutdown_chord.configure(pins, inhibit_pins, GPIO.input, active_level)
+            for pin_num in old | self.shutdown_chord.watched:
+                self._watch_edges(pin_num)
+
+    def _shutdown(self):
+        print(f"Shutting down")
+        os.system(SHUTDOWN_COMMAND)
+
+    def set_serial(self, port, baudrate):
+        """ Use a different serial port, closing the old one so the next write opens the new one """
+        if (port, baudrate) != (self.serial_port, self.serial_baudrate) and self.serial is not None:
+            self.serial.close()
+            self.serial = None
+        self.serial_port = port
+        self.serial_baudrate = baudrate
+
 
     def get(self, id):
-        for pin in self.pins:
-            if pin['id'] == id:
-                return pin
-        api.abort(404, f"pin {id} doesn't exist.")
-
-
-    def create(self, data):
-        pin = data
-        pin['id'] = self.counter = self.counter + 1
-        self.pins.append(pin)
-        self.last_pinchange_time = time.clock_gettime(1)
-        print(f"Creating {pin['direction']} pin {self.counter} for {pin['name']} on pin {pin['pin_num']}")
-
-        if pin['direction'] == 'in':
-            GPIO.setup(pin['pin_num'], GPIO.IN, pull_up_down=self.pull_up_down)
-            pin['state'] = 'on' if GPIO.input(pin['pin_num']) else 'off'
-
-            if 'rising_video' in pin:
-                filename = pin['rising_video']
-                if os.path.exists(filename):
-                    print(f"rising_video is {filename}")
-                elif os.path.exists(f"/home/pi/{filename}"):
-                    pin['rising_video'] = f"/home/pi/{filename}"
-                    print(f"rising_video is /home/pi/{filename}")
-                else:
-                    print(f"Can't find {filename} or /home/pi/{filename}")
-
-            if 'falling_video' in pin:
-                filename = pin['falling_video']
-                if not os.path.exists(filename):
-                    print(f"falling_video is {filename}")
-                elif os.path.exists(f"/home/pi/{filename}"):
-                    pin['falling_video'] = f"/home/pi/{filename}"
-                    print(f"falling_video is /home/pi/{filename}")
-                else:
-                    print(f"Can't find {filename} or /home/pi/{filename}")
+        pin = self.pins.get(id)
+        if pin is None:
+            api.abort(404, f"pin {id} doesn't exist.")
+        return pin
 
-            if 'rising_url' in pin:
-                if 'falling_url' in pin:
-                    GPIO.add_event_detect(pin['pin_num'], GPIO.BOTH, callback=self.pin_change,
-                                  bouncetime=GPIO_BOUNCE_TIME)
-                else:
-                    GPIO.add_event_detect(pin['pin_num'], GPIO.RISING, callback=self.pin_change,
-                                  bouncetime=GPIO_BOUNCE_TIME)
+    def view(self, id):
+        """ A copy of the pin as last published, to read without any lock """
+        pin = self.events.pin(id)
+        if pin is None:
+            api.abort(404, f"pin {id} doesn't exist.")
+        return pin
+
+    def find(self, name):
+        pin = self.pins.find(name)
+        if pin is None:
+            api.abort(404, f"pin {name} doesn't exist.")
+        return pin
+
+
+    def _pin_lock(self, pin_num):
+        lock = self._pin_locks.get(pin_num)
+        if lock is None:
+            lock = self._pin_locks.setdefault(pin_num, TimedLock(mutex_wait_seconds, 'gpio'))
+        return lock
+
+    @contextmanager
+    def _locked(self, pins, pin_nums=()):
+        """
+        Hold the locks of the GPIO pins the pins are on, and of any other
+        pin_nums, giving the pins that are still configured. A pin moved to
+        another GPIO pin while waiting is locked again where it is now.
+        """
+        while True:
+            locked = sorted({pin.pin_num for pin in pins} | set(pin_nums))
+            with ExitStack() as stack:
+                for pin_num in locked:
+                    stack.enter_context(self._pin_lock(pin_num))
+                if all(pin.pin_num in locked for pin in pins):
+                    yield [pin for pin in pins if self.pins.get(pin.id) is pin]
+                    return
+
+    def create(self, data, setup=True):
+        try:
+            pin = pins.Pin(data)
+        except ValueError as e:
+            api.abort(400, str(e))
+        # The locks are re-entrant, as reload() creates pins while holding the registry lock
+        with self._registry_lock, self._pin_lock(pin.pin_num):
+            if self.pins.name_clash(pin.name):
+                api.abort(409, f"pin {pin.name} already exists.")
+            pin.id = self.counter = self.counter + 1
+            self.pins.add(pin)
+            print(f"Creating {pin.direction} pin {self.counter} for {pin.name} on pin {pin.pin_num}")
+
+            if pin.direction == 'in':
+                if setup:
+                    GPIO.setup(pin.pin_num, GPIO.IN, pull_up_down=self.pull_up_down)
+                pin.state = 'on' if GPIO.input(pin.pin_num) else 'off'
+
+                self._resolve_actions(pin)
+                self._configure_debounce(pin)
+                self._watch_edges(pin.pin_num)
+                self._journal_config(pin)
+                self.events.publish(pin)
+                return self.events.pin(pin.id)
             else:
-                if 'falling_url' in pin:
-                    GPIO.add_event_detect(pin['pin_num'], GPIO.FALLING, callback=self.pin_change,
-                                  bouncetime=GPIO_BOUNCE_TIME)
+                # It is an output pin
+                if setup:
+                    GPIO.setup(pin.pin_num, GPIO.OUT)
+
+                    if pin.state == 'off':
+                        GPIO.output(pin.pin_num, GPIO.LOW)
+                    elif pin.state == 'on':
+                        GPIO.output(pin.pin_num, GPIO.HIGH)
+
+            self._journal_config(pin)
+            self.events.publish(pin)
+            return self.events.pin(pin.id)
+
+    def _resolve_actions(self, pin):
+        """
+        Work out what an input does on each edge, once, so an edge only has
+        to hand the list to the dispatcher. Videos given without a full path
+        are looked for in the media directories.
+        """
+        for key in ('rising_video', 'falling_video'):
+            if getattr(pin, key) is not None and not os.path.isabs(getattr(pin, key)):
+                setattr(pin, key, resolve_media(getattr(pin, key)))
+                print(f"{key} is {getattr(pin, key)}")
+        for edge in ('rising', 'falling'):
+            actions = []
+            url, video, text = (getattr(pin, f'{edge}_{kind}') for kind in ('url', 'video', 'serial'))
+            if url is not None:
+                actions.append((urlparse(url).netloc, pin.id, f"{edge}_url {url}", self._get_url, url))
+            if video is not None:
+                # Only the latest video matters, whichever pin asked for it
+                actions.append(('video', 'video', f"{edge}_video {video}", self.switch_vid, video))
+            if text is not None:
+                actions.append(('serial', pin.id, f"{edge}_serial {text}", self._write_serial, text))
+            setattr(pin, edge, tuple(actions) if pin.direction == 'in' else ())
+
+    def _watch_edges(self, pin_num):
+        """
+        Start or stop edge detection on a GPIO pin, depending on whether
+        any input on it has something to do when it changes, or it is one
+        of the shutdown pins.
+        """
+        with self._watching_lock:
+            wanted = any(pin.direction == 'in' and (pin_num in self.shutdown_chord.watched or pin.has_actions)
+                         for pin in self.pins.on_pin_num(pin_num))
+            if wanted and pin_num not in self._watching:
+                # Watch both edges even if only one has actions, so the debouncer
+                # always knows the real level of the pin
+                GPIO.add_event_detect(pin_num, GPIO.BOTH, callback=self.pin_change, bouncetime=GPIO_BOUNCE_TIME)
+                self._watching.add(pin_num)
+            elif not wanted and pin_num in self._watching:
+                GPIO.remove_event_detect(pin_num)
+                self._watching.discard(pin_num)
+
+    def watching(self):
+        """ The GPIO pins with edge detection turned on """
+        with self._watching_lock:
+            return sorted(self._watching)
+
+    def delete(self, id):
+        with self._registry_lock:
+            pin = self.get(id)
+            print(f"Removing {pin.direction} pin {id} for {pin.name} on pin {pin.pin_num}")
+            with self._pin_lock(pin.pin_num):
+                self.pins.remove(pin)
+                pin_json.forget(id)
+                if pin.direction == 'in':
+                    self._watch_edges(pin.pin_num)
+                    if not any(other.direction == 'in' for other in self.pins.on_pin_num(pin.pin_num)):
+                        self.debouncer.remove(pin.pin_num)
+                self.events.publish(pin, 'removed')
+            if self.journal is not None and pin.name is not None:
+                self.journal.config(pin.name, None)
             return pin
-        else:
-            # It is an output pin
-            GPIO.setup(pin['pin_num'], GPIO.OUT)
 
-            if pin['state'] == 'off':
-                GPIO.output(pin['pin_num'], GPIO.LOW)
-            elif pin['state'] == 'on':
-                GPIO.output(pin['pin_num'], GPIO.HIGH)
+    def reload(self, layout_pins):
+        """
+        Bring the live pins into line with a new layout, matching pins by
+        name. Only pins that are new, gone or configured differently are
+        touched; the rest keep their state. A pin that has moved to another
+        GPIO pin or changed direction is recreated, and anything else is
+        changed in place. Every pin is checked first, so a bad one raises
+        LayoutError with nothing changed.
+        """
+        for data in layout_pins:
+            try:
+                pins.Pin(data)
+            except ValueError as e:
+                raise LayoutError(f"pin {data.get('name')}: {e}")
+        config = lambda data: {key: data[key] for key in PIN_KEYS
+                               if key != 'state' and data.get(key) is not None}
+        new = {pin['name']: pin for pin in layout_pins}
+        summary = {'added': [], 'removed': [], 'changed': [], 'unchanged': []}
+
+        with self._registry_lock:
+            for pin in self.pins:
+                if pin.name not in new:
+                    self.delete(pin.id)
+                    summary['removed'].append(pin.name)
 
-        return pin
+            for name, data in new.items():
+                pin = self.pins.find(name)
+                if pin is None:
+                    self.create(dict(data))
+                    summary['added'].append(name)
+                elif pin.config() == config(data):
+                    summary['unchanged'].append(name)
+                elif pin.pin_num != data['pin_num'] or pin.direction != data['direction']:
+                    self.delete(pin.id)
+                    self.create(dict(data))
+                    summary['changed'].append(name)
+                else:
+                    self._reconfigure(pin, config(data))
+                    summary['changed'].append(name)
+        print(f"Reloaded layout: {', '.join(f'{len(v)} {k}' for k, v in summary.items())}")
+        return summary
+
+    def _reconfigure(self, pin, config):
+        """ Change the settings of a pin without touching its state """
+        changes = {key: config.get(key) for key in PIN_KEYS if key not in ('state', 'pin_num', 'direction', 'name')}
+        try:
+            pins.Pin.check(changes, pin)
+        except ValueError as e:
+            api.abort(400, f"pin {pin.name}: {e}")
+        with self._pin_lock(pin.pin_num):
+            old_debounce = (pin.debounce, pin.debounce_mode)
+            pin.update(changes)
+            self._resolve_actions(pin)
+            if pin.direction == 'in':
+                if (pin.debounce, pin.debounce_mode) != old_debounce:
+                    self._configure_debounce(pin)
+                self._watch_edges(pin.pin_num)
+            self.events.publish(pin)
+
+    def create_many(self, pins):
+        """
+        Create all the pins of a layout. The GPIO pins are set up a group
+        at a time, with outputs starting at their initial level.
+        """
+        inputs = [pin['pin_num'] for pin in pins if pin['direction'] == 'in']
+        if inputs:
+            GPIO.setup(inputs, GPIO.IN, pull_up_down=self.pull_up_down)
+        for state, initial in (('off', GPIO.LOW), ('on', GPIO.HIGH)):
+            outputs = [pin['pin_num'] for pin in pins if pin['direction'] == 'out' and pin.get('state') == state]
+            if outputs:
+                GPIO.setup(outputs, GPIO.OUT, initial=initial)
+        outputs = [pin['pin_num'] for pin in pins if pin['direction'] == 'out' and pin.get('state') not in ('on', 'off')]
+        if outputs:
+            GPIO.setup(outputs, GPIO.OUT)
+        return [self.create(pin, setup=False) for pin in pins]
 
 
     def update(self, id, data):
         print("Update", id, "data", data)
         if data is None:
             api.abort(400, "Must supply data")
+        if not isinstance(data, dict):
+            api.abort(400, "pin should be an object")
+        data = dict(data)
+        wait = data.pop('wait', False)
+        for key in pins.READONLY_KEYS:
+            data.pop(key, None)
         pin = self.get(id)
-        pin.update(data)  # this is the dict_object update method
+        try:
+            pins.Pin.check(data, pin)
+        except ValueError as e:
+            api.abort(400, str(e))
+        # Only renaming or moving a pin needs the registry, and moving it the lock of where it's going
+        structural = 'name' in data or 'pin_num' in data
+        with (self._registry_lock if structural else nullcontext()), \
+                self._locked([pin], [data['pin_num']] if 'pin_num' in data else []) as live:
+            if not live:
+                api.abort(404, f"pin {id} doesn't exist.")
+            if data.get('name') is not None and self.pins.name_clash(data['name'], id):
+                api.abort(409, f"pin {data['name']} already exists.")
+            old_name, old_pin_num = pin.name, pin.pin_num
+            pin.update(data)
+            self.pins.reindex(pin, old_name, old_pin_num)
+            if set(data) - {'state'}:
+                self._resolve_actions(pin)
+                self._journal_config(pin, old_name)
         
-        if pin['direction'] == 'in':
-            pin['state'] = 'on' if GPIO.input(pin['pin_num']) else 'off'
-            return pin
+            if pin.direction == 'in':
+                if 'debounce' in data or 'debounce_mode' in data:
+                    self._configure_debounce(pin)
+                if set(data) & set(pins.EDGE_ACTION_KEYS) or 'pin_num' in data:
+                    for pin_num in {old_pin_num, pin.pin_num}:
+                        self._watch_edges(pin_num)
+                pin.state = 'on' if GPIO.input(pin.pin_num) else 'off'
+                self.events.publish(pin)
+                return self.events.pin(id)
 
-        if pin['state'] == 'off':
-            GPIO.output(pin['pin_num'], GPIO.LOW)
-        elif pin['state'] == 'on':
-            GPIO.output(pin['pin_num'], GPIO.HIGH)
-        elif pin['state'] == 'pulse':
-            GPIO.output(pin['pin_num'], GPIO.HIGH)
-            time.sleep(pulse_period)
-            GPIO.output(pin['pin_num'], GPIO.LOW)
-            pin['state'] = 'off'
-            time.sleep(gap_period)
-        elif pin['state'] == 'pulse01':
-            GPIO.output(pin['pin_num'], GPIO.LOW)
-            time.sleep(pulse_period)
-            GPIO.output(pin['pin_num'], GPIO.HIGH)
-            pin['state'] = 'on'
-            time.sleep(gap_period)
-        return pin
+            state = pin.state
+            sequence = None
+            if state == 'off':
+                self.scheduler.set(pin.pin_num, GPIO.LOW)
+            elif state == 'on':
+                self.scheduler.set(pin.pin_num, GPIO.HIGH)
+            elif state in ('pulse', 'pulse01'):
+                sequence = self._start_pulse(pin)
+            self.events.publish(pin, state)
+            published = self.events.pin(id)
+        if sequence and wait:
+            sequence.done.wait()
+            # Give back the pin as the pulse left it, unless it has been removed since
+            return self.events.pin(id) or published
+        return published
+
+    def _start_pulse(self, pin):
+        if pin.state == 'pulse':
+            level, rest_level, pin.state = GPIO.HIGH, GPIO.LOW, 'off'
+        else:
+            level, rest_level, pin.state = GPIO.LOW, GPIO.HIGH, 'on'
+        pin.pulses_pending = (pin.pulses_pending or 0) + 1
+        return self.scheduler.pulse(pin.pin_num, level, rest_level,
+                                    on_done=lambda: self._pulse_done(pin))
+
+    def _pulse_done(self, pin):
+        with self._locked([pin]) as live:
+            pin.pulses_pending -= 1
+            if live:
+                self.events.publish(pin)
+
+    def batch(self, changes):
+        """
+        Set the state of several output pins in one go.
+
+        Each change selects pins by id, name, color or a name pattern such
+        as 'lh-*', and gives the state to set. Every change is checked
+        before any pin is touched, and then all the on/off changes are
+        written in a single GPIO call.
+        """
+        if not isinstance(changes, list):
+            api.abort(400, "Must supply a list of changes")
+
+        selected = {}
+        for change in changes:
+            if not isinstance(change, dict) or change.get('state') not in PIN_STATES:
+                api.abort(400, f"Each change needs a state of {', '.join(PIN_STATES)}")
+            if change.get('id') is not None and (not isinstance(change['id'], int) or isinstance(change['id'], bool)):
+                api.abort(400, "id should be a pin id")
+            for key in ('name', 'color', 'match'):
+                if change.get(key) is not None and not isinstance(change[key], str):
+                    api.abort(400, f"{key} should be a string")
+            if change.get('id') is not None:
+                chosen = [self.get(change['id'])]
+            elif change.get('name') is not None:
+                chosen = [self.find(change['name'])]
+            elif change.get('color') is not None:
+                chosen = [pin for pin in self.pins if pin.color == change['color']]
+            elif change.get('match') is not None:
+                chosen = [pin for pin in self.pins if fnmatch.fnmatchcase(pin.name or '', change['match'])]
+            else:
+                api.abort(400, "Each change needs an id, name, color or match")
+            for pin in chosen:
+                if pin.direction != 'out':
+                    if change.get('id') is not None or change.get('name') is not None:
+                        api.abort(400, f"pin {pin.name} is not an output")
+                    continue
+                # A later change to the same pin wins
+                selected.pop(pin.id, None)
+                selected[pin.id] = (pin, change['state'])
+
+        with self._locked([pin for pin, state in selected.values()]) as live:
+            print(f"Batch update of {len(live)} pins")
+            live = {pin.id for pin in live}
+            levels = {}
+            changed = []
+            for pin, state in selected.values():
+                if pin.id not in live:
+                    continue
+                pin.state = state
+                if state in ('pulse', 'pulse01'):
+                    self._start_pulse(pin)
+                else:
+                    levels[pin.pin_num] = GPIO.HIGH if state == 'on' else GPIO.LOW
+                self.events.publish(pin, state)
+                changed.append(self.events.pin(pin.id))
+            self.scheduler.set_many(levels)
+        return changed
+
+    def ring(self, name, data):
+        """
+        Queue a bell code, or an explicit list of [on, off] durations,
+        on a named output pin.
+        """
+        pin = self.find(name)
+        if pin.direction != 'out':
+            api.abort(400, f"pin {name} is not an output")
+        if data is None:
+            api.abort(400, "Must supply data")
+        if not isinstance(data, dict):
+            api.abort(400, "ring should be an object")
+        if data.get('code') is not None and not isinstance(data['code'], str):
+            api.abort(400, "code should be a string")
+
+        try:
+            if data.get('code'):
+                steps = bell_code_steps(data['code'])
+            elif data.get('pattern'):
+                steps = [(float(on), float(off)) for on, off in data['pattern']]
+                # Written so NaN fails too
+                if not all(0 <= duration <= max_step_time for step in steps for duration in step):
+                    raise ValueError(f"pattern durations should be from 0 to {max_step_time} secs")
+            else:
+                raise ValueError("Must supply a code or a pattern")
+        except (TypeError, ValueError) as e:
+            api.abort(400, str(e))
+        if len(steps) > max_sequence_steps:
+            api.abort(400, f"pattern is longer than {max_sequence_steps} steps")
+
+        with self._locked([pin]) as live:
+            if not live:
+                api.abort(404, f"pin {name} doesn't exist.")
+            if data.get('state', 'pulse') == 'pulse01':
+                level, rest_level, pin.state = GPIO.LOW, GPIO.HIGH, 'on'
+            else:
+                level, rest_level, pin.state = GPIO.HIGH, GPIO.LOW, 'off'
+
+            pin.pulses_pending = (pin.pulses_pending or 0) + 1
+            sequence = PulseSequence(pin.pin_num, level, rest_level, steps,
+                                     on_done=lambda: self._pulse_done(pin))
+            sequence.name = name
+            # Queued before it can be looked up, so it always has a start and end
+            self.scheduler.play(sequence)
+            # Rings on different GPIO pins don't share a pin lock
+            with self._sequence_lock:
+                sequence.id = self.sequence_counter = self.sequence_counter + 1
+                self.sequences[sequence.id] = sequence
+                # Only keep the most recent sequences for polling
+                while len(self.sequences) > max_sequences_kept:
+                    self.sequences.popitem(last=False)
+
+            self.events.publish(pin, 'pulse')
+        print(f"Ringing {len(steps)} beats on {name}")
+        return sequence
+
+    def stream(self, since=None, names=None):
+        """
+        Generate Server-Sent Events for pin changes after sequence number since.
+        A new client, or one that has missed too much, first gets a snapshot
+        of all the pins.
+        """
+        seq = since
+        while True:
+            events = self.events.since(seq) if seq is not None else None
+            if events is None:
+                seq = self.events.seq
+                yield sse('snapshot', [{'id': pin['id'], 'name': pin.get('name'), 'state': pin.get('state')}
+                                       for pin in self.events.all() if not names or pin.get('name') in names],
+                          self.events.version(seq))
+                continue
+            for event in events:
+                seq = event['seq']
+                if not names or event['name'] in names:
+                    yield sse('pin', event, self.events.version(seq))
+            if not self.events.wait(seq, EVENT_KEEPALIVE):
+                yield ": keepalive\n\n"
+
+    def changed_since(self, version):
+        """ The pins that have changed since a pins version """
+        return [pin for pin in self.events.all() if pin.get('version', 0) > version]
+
+    def get_sequence(self, id):
+        with self._sequence_lock:
+            sequence = self.sequences.get(id)
+        if sequence is None:
+            api.abort(404, f"sequence {id} doesn't exist.")
+        return sequence
+
+    def cancel_sequence(self, id):
+        sequence = self.get_sequence(id)
+        self.scheduler.cancel(sequence)
+        return sequence
+
+    def start_show(self, data):
+        """
+        Play a lightshow pattern on a group of output pins, on a thread of
+        its own. Any show already playing on one of the pins is stopped
+        first, so only one pattern runs on them at a time.
+        """
+        if data is None:
+            api.abort(400, "Must supply data")
+        if not isinstance(data, dict):
+            api.abort(400, "show should be an object")
+        group, pattern, name, params = self._show_pattern(data)
+        run_time = data.get('run_time') or show_run_time
+        if not isinstance(run_time, (int, float)) or not 0 < run_time <= max_show_time:
+            api.abort(400, f"run_time should be up to {max_show_time} seconds")
+        try:
+            timeline = patterns.compile_pattern(pattern, len(group), run_time, max_show_frames, **params)
+        except (TypeError, ValueError) as e:
+            api.abort(400, f"Can't play {name}: {e}")
+        if timeline.length <= 0:
+            api.abort(400, f"{name} has no steps that take any time")
+        if timeline.length > max_show_time:
+            api.abort(400, f"{name} runs for more than {max_show_time} seconds")
+
+        show = LightShow(name, group, timeline)
+        ids = {pin.id for pin in group}
+        with self._show_lock:
+            for other in list(self.shows.values()):
+                if not other.done.is_set() and ids & {pin.id for pin in other.group}:
+                    print(f"Stopping show {other.id} to start {name}")
+                    other.stop()
+            show.id = self.show_counter = self.show_counter + 1
+            self.shows[show.id] = show
+            # Only keep the most recent finished shows for polling
+            for old in list(self.shows.values()):
+                if len(self.shows) <= max_sequences_kept:
+                    break
+                if old.done.is_set():
+                    del self.shows[old.id]
+            show.start = time.monotonic()
+            Thread(target=self._play_show, args=(show,), name=f'show-{show.id}', daemon=True).start()
+        return show
+
+    def _show_pattern(self, data):
+        """ The pins a show plays on, and the pattern function, name and parameters to play there """
+        for key in ('color', 'match'):
+            if data.get(key) is not None and not isinstance(data[key], str):
+                api.abort(400, f"{key} should be a string")
+        if data.get('pins') is not None and not (isinstance(data['pins'], list)
+                                                 and all(isinstance(name, str) for name in data['pins'])):
+            api.abort(400, "pins should be a list of pin names")
+        if data.get('steps') is not None and not (isinstance(data['steps'], list) and all(
+                isinstance(step, dict) and isinstance(step.get('on', []), list)
+                and all(isinstance(name, str) for name in step.get('on', [])) for step in data['steps'])):
+            api.abort(400, 'steps should be a list of {"on": [pin names], "hold": secs}')
+        if data.get('pins') is not None:
+            group = [self.find(name) for name in data['pins']]
+        elif data.get('color') is not None:
+            group = [pin for pin in self.pins if pin.color == data['color']]
+        elif data.get('match') is not None:
+            group = [pin for pin in self.pins if fnmatch.fnmatchcase(pin.name or '', data['match'])]
+        elif data.get('steps') is not None:
+            names = [name for step in data['steps'] for name in step.get('on', [])]
+            group = [self.find(name) for name in dict.fromkeys(names)]
+        else:
+            group = [pin for pin in self.pins if pin.direction == 'out']
+        if data.get('pins') is not None or data.get('steps') is not None:
+            for pin in group:
+                if pin.direction != 'out':
+                    api.abort(400, f"pin {pin.name} is not an output")
+        group = [pin for pin in group if pin.direction == 'out']
+        if not group:
+            api.abort(400, "No output pins to play the pattern on")
+
+        if not isinstance(data.get('params') or {}, dict):
+            api.abort(400, "params should be an object")
+        params = dict(data.get('params') or {})
+        if data.get('steps') is not None:
+            return group, self._steps_pattern(data['steps'], group), 'steps', params
+        name = data.get('pattern')
+        if name not in patterns.PATTERNS:
+            api.abort(400, f"pattern should be one of {', '.join(patterns.PATTERNS)}, or steps of your own")
+        if 'rand' in params:
+            api.abort(400, "rand can't be set")
+        if name == 'rainbow' and 'groups' not in params:
+            colors = params.pop('colors', rainbow_colors)
+            if not isinstance(colors, (list, tuple)):
+                api.abort(400, "colors should be a list")
+            params['groups'] = [sum(1 << n for n, pin in enumerate(group) if pin.color == color)
+                                for color in colors]
+        return group, patterns.PATTERNS[name], name, params
+
+    def _steps_pattern(self, steps, group):
+        """ A pattern function for a list of {"on": [names], "hold": secs} steps """
+        index = {pin.name: n for n, pin in enumerate(group)}
+        try:
+            masks = [(sum(1 << index[name] for name in step.get('on', [])), float(step['hold']))
+                     for step in steps]
+        except KeyError as e:
+            api.abort(400, f"Each step needs a hold, and pins from the show: {e}")
+        except (AttributeError, TypeError, ValueError):
+            api.abort(400, 'steps should be a list of {"on": [pin names], "hold": secs}')
+        if not masks:
+            api.abort(400, "steps is empty")
+        return lambda pins: iter(masks)
+
+    def _play_show(self, show):
+        saved = {pin.id: pin.state for pin in show.group}
+
+        def output(channels, values):
+            levels = dict(zip(channels, values))
+            # Only the show's own pins are locked, so levers elsewhere carry on regardless
+            with self._locked(show.group) as live:
+                self.scheduler.set_many(levels)
+                for pin in live:
+                    if pin.pin_num in levels:
+                        pin.state = 'on' if levels[pin.pin_num] else 'off'
+                        self.events.publish(pin)
+
+        try:
+            print(f"Playing {show.pattern} on {', '.join(str(name) for name in show.pins)} for {show.run_time:.1f}s")
+            patterns.play(show.timeline, [pin.pin_num for pin in show.group], show.start, show._stop,
+                          output=output)
+        finally:
+            try:
+                # Put the pins back as they were before the show
+                output([pin.pin_num for pin in show.group],
+                       [GPIO.HIGH if saved[pin.id] == 'on' else GPIO.LOW for pin in show.group])
+            finally:
+                show.done.set()
+
+    def get_show(self, id):
+        show = self.shows.get(id)
+        if show is None:
+            api.abort(404, f"show {id} doesn't exist.")
+        return show
+
+    def stop_show(self, id):
+        show = self.get_show(id)
+        show.stop()
+        return show
 
+    def available_patterns(self):
+        """ The built-in patterns, and the parameters each takes """
+        available = []
+        for name, pattern in patterns.PATTERNS.items():
+            params = {param.name: param.default for param in list(inspect.signature(pattern).parameters.values())[1:]
+                      if param.name != 'rand'}
+            if name == 'rainbow':
+                # Given colors, the server works out the groups
+                params['colors'] = list(rainbow_colors)
+            available.append({'name': name, 'params': params, 'description': (inspect.getdoc(pattern) or '').strip()})
+        return available
+
+
+    def _configure_debounce(self, pin):
+        self.debouncer.configure(pin.pin_num, (DEBOUNCE_TIME if pin.debounce is None else pin.debounce) / 1000,
+                                 pin.debounce_mode or DEBOUNCE_MODE)
 
     def pin_change(self, pin_num):
         """
-        Send any appropriate request for the changed pin.
-        
+        GPIO edge callback. Only note the edge, so the callback thread
+        is never held up by the actions it triggers.
+        """
+        edges_total.inc(pin_num)
+        self.debouncer.edge(pin_num)
+
+    def _debounced(self, pin_num, level, when):
+        """ Called by the debouncer once an input has settled at a new level """
+        try:
+            self._edges.put_nowait((when, pin_num, level))
+        except Full:
+            print(f"Edge queue full, dropping edge on pin {pin_num}")
+
+    def _edge_loop(self):
+        while True:
+            when, pin_num, level = self._edges.get()
+            try:
+                self._process_edge(pin_num, level, when)
+            except Exception as e:
+                print(f"Failed to process edge on pin {pin_num}: {e}")
+
+    def _process_edge(self, pin_num, level, when):
+        """
+        Queue any appropriate actions for the changed pin.
+
         """
-        # Use a mutex lock to avoid race condition when
-        # multiple inputs change in quick succession
-        with self._mutex:
-            # If we haven't been here recently, this could be the first transition of a cluster caused by noise
-            if self.last_pinchange_time < time.clock_gettime(1) - 0.1:
-                time.sleep(0.1)
-                self.last_pinchange_time = time.clock_gettime(1)
-            new_state = 'on' if GPIO.input(pin_num) else 'off'
+        # Shut down once all the shutdown pins, and none of the inhibit pins, have been held on
+        self.shutdown_chord.level(pin_num, level)
+
+        # Only this GPIO pin is locked, so a request for another pin doesn't hold up the edge
+        with self._pin_lock(pin_num):
+            new_state = 'on' if level else 'off'
             # print (f"pin {pin_num} state {new_state}")
 
-            # If we are a shutdown pin
-            # And all the shutdown pins are set
-            # And all the shutdown inhibit pins are NOT set
-            # then
-            #   os.system("sudo halt")
-            #   os.system("sudo shutdown -h now")
-            if pin_num in shutdown_pins and new_state = 'on':
-                shutdown_reqd = True
-                print(f"Pin {pin_num} is a shutdown pin, so testing if shutdown required")
-                # If any shutdown pin is not set, then we don't shutdown
-                for p in shutdown_pins:
-                    if not GPIO.input(p):
-                        print(f"Pin {p} is not set, so shutdown not required")
-                        shutdown_reqd = False
-                # If any shutdown Inhibit pin IS set, then we don't shutdown
-                for p in shutdown_inhibit_pins:
-                    if GPIO.input(p):
-                        print(f"Pin {p} is set, so shutdown not required")
-                        shutdown_reqd = False
-                if shutdown_required:
-                    print(f"Shutting down")
-                    os.system("sudo halt")
-
-            # Look for a 'pin' on this pin_num
-            for pin in pin_util.pins:
-                # print (f"Comparing {pin_num} to {pin['pin_num']} and {pin['state']} to {new_state}")
-                # If found it and it has changed
-                if pin['pin_num'] == pin_num:
-                    # print ("Found pin", pin_num, pin['name'])
-                    if pin['state'] != new_state:
-                        print ("Input changed state from", pin['state'], "to", new_state)
-                        pin['state'] = new_state
-                        if new_state == 'on':
-                            if 'rising_url' in pin:
-                                print('Calling rising_url', pin['rising_url'], new_state)
-                                requests.get(pin['rising_url'])
-                            if 'rising_video' in pin:
-                                print('Calling rising_video', pin['rising_video'], new_state)
-                                self.switch_vid(pin['rising_video'])
-                            if 'rising_serial' in pin:
-                                print('Calling rising_serial', pin['rising_serial'], new_state)
-                                # ser.write(pin['rising_serial'])
-                        if new_state == 'off':
-                            if 'falling_url' in pin:
-                                print('Calling falling_url', pin['falling_url'], new_state)
-                                requests.get(pin['falling_url'])
-                            if 'falling_video' in pin:
-                                print('Calling falling_video', pin['falling_video'], new_state)
-                                self.switch_vid(pin['falling_video'])
-                            if 'falling_serial' in pin:
-                                print('Calling falling_serial', pin['falling_serial'], new_state)
-                                # ser.write(pin['falling_serial'])
-                    return
+            # Look for the 'pins' on this pin_num
+            for pin in self.pins.on_pin_num(pin_num):
+                # print ("Found pin", pin_num, pin.name)
+                # If it has changed
+                if pin.state != new_state:
+                    print ("Input changed state from", pin.state, "to", new_state)
+                    pin.state = new_state
+                    self.events.publish(pin)
+                    self._queue_actions(pin.rising if level else pin.falling, when)
 
-# Following based on vidlooper.py
-    def switch_vid(self, filename):
-        """ Switch to the video corresponding to the shorted pin """
+    def _queue_actions(self, actions, when):
+        """ Hand the actions worked out by _resolve_actions for an edge to the dispatcher """
+        for target, key, description, func, arg in actions:
+            print(f'Calling {description}')
+            self.dispatcher.submit(Action(target, key, description, func, arg, when=when))
 
+    def _get_url(self, url):
+        host = urlparse(url).netloc
+        try:
+            with webhook_seconds.time(host):
+                r = self.http.get(url, timeout=URL_TIMEOUT)
+        except requests.RequestException:
+            webhook_failures_total.inc(host)
+            raise
+        # Only retry if the server had a problem, not if it didn't like the request
+        if r.status_code >= 500:
+            webhook_failures_total.inc(host)
+            raise requests.HTTPError(f"{url} returned {r.status_code}")
+
+    def _write_serial(self, text):
+        # The dispatcher only runs one 'serial' action at a time, so there's no race to open the port
+        if self.serial is None:
+            self.serial = SerialOutput(self.serial_port, self.serial_baudrate)
+        self.serial.write(text)
+
+    def switch_vid(self, filename):
+        """ Switch to the video (or audio cue) corresponding to the shorted pin """
         print(f"switch_vid {filename}")
+        with video_switch_seconds.time():
+            self.player.play(filename)
+
+    def preload_media(self):
+        """ Start the video player with every rising_video and falling_video ready to play """
+        filenames = [video for pin in self.pins for video in (pin.rising_video, pin.falling_video) if video is not None]
+        if filenames:
+            try:
+                self.player.preload(filenames)
+            except OSError as e:
+                print(f"Can't start the video player: {e}")
+
+class PinJSON(object):
+    """
+    Pins already marshalled with pin_model and encoded as JSON.
+
+    Each pin is kept with the version it was encoded at, and re-encoded
+    only once its version moves on, so listing pins that haven't changed
+    is just joining bytes.
+    """
+    def __init__(self):
+        self._pins = {}
+        self._list = {}
+
+    def pin(self, pin, skip_none):
+        version = pin.get('version')
+        cached = self._pins.get((pin['id'], skip_none))
+        if cached is None or cached[0] != version:
+            cached = (version, json.dumps(marshal(pin, pin_model, skip_none=skip_none)).encode())
+            self._pins[(pin['id'], skip_none)] = cached
+        return cached[1]
+
+    def pins(self, pins, skip_none):
+        return b'[' + b','.join(self.pin(pin, skip_none) for pin in pins) + b']'
+
+    def all(self, pin_util, skip_none):
+        version = pin_util.events.seq
+        cached = self._list.get(skip_none)
+        if cached is None or cached[0] != version:
+            cached = self._list[skip_none] = (version, self.pins(pin_util.events.all(), skip_none))
+        return cached[1]
+
+    def forget(self, id):
+        for skip_none in (False, True):
+            self._pins.pop((id, skip_none), None)
+
+
+pin_json = PinJSON()
+
+registry.collected('restful_pi_debounce_rejected_total', 'Bursts of edges on an input that came to nothing',
+                   lambda: {(pin_num,): pin_util.debouncer.rejected(pin_num) for pin_num in pin_util.watching()},
+                   ('pin_num',), 'counter')
+registry.collected('restful_pi_action_queue_depth', 'Input actions waiting to be delivered',
+                   lambda: pin_util.dispatcher.depth())
+registry.collected('restful_pi_actions_dropped_total',
+                   "Input actions dropped, or replaced by a newer one with the same key, as their queue was full",
+                   lambda: pin_util.dispatcher.dropped, type='counter')
+registry.collected('restful_pi_edge_queue_depth', 'Debounced edges waiting to be processed',
+                   lambda: pin_util._edges.qsize())
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_time(response):
+    if 'start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_seconds.observe(time.perf_counter() - g.start, route, request.method)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """ Counters and histograms in Prometheus' text format """
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def pin_response(body, etag, headers=None):
+    """
+    Reply with the JSON made by body(), or 304 Not Modified if the client
+    already has this version.
+    """
+    headers = dict(headers or {}, ETag=f'"{etag}"')
+    if request.if_none_match.contains_weak(str(etag)):
+        return Response(status=304, headers=headers)
+    return Response(body(), 200, headers, mimetype='application/json')
 
-        if filename != self._active_vid:
-            # Kill any previous video player process
-            self._kill_process()
-            # Start a new video player process, capture STDOUT to keep the
-            # screen clear. Set a session ID (os.setsid) to allow us to kill
-            cmd = ['cvlc', '--fullscreen', f"file://{filename}"]
-            print(cmd)
-
-            self._p = Popen(cmd, stdout=None if self.debug else PIPE, preexec_fn=os.setsid)
-            self._active_vid = filename
-
-    def _kill_process(self):
-        """ Kill a video player process. SIGINT seems to work best. """
-        if self._p is not None:
-            os.killpg(os.getpgid(self._p.pid), signal.SIGINT)
-            print(f"Killing process {self._p.pid}")
-            self._p = None
-        else:
-            print("No video running")
-# end vidlooper.py bits
 
 @ns.route('/')  # keep in mind this our ns-namespace (pins/)
+@ns.response(304, 'pins not modified since If-None-Match')
 class PinList(Resource):
     """Shows a list of all pins, and lets you POST to add new pins"""
 
-    @ns.marshal_list_with(pin_model)
+    @ns.param('since', 'Only list the pins changed since this X-Pins-Version')
+    @ns.param('skip_none', 'Leave out fields that are not set')
+    @ns.response(200, 'Success', [pin_model])
     def get(self):
         """List all pins"""
-        return pin_util.pins
+        parser = reqparse.RequestParser()
+        parser.add_argument('since')
+        parser.add_argument('skip_none', type=inputs.boolean, default=SKIP_NONE)
+        args = parser.parse_args()
+        skip = args.pop('skip_none')
+        version = pin_util.events.version()
+        headers = {'X-Pins-Version': version}
+        if args['since'] is not None:
+            since = pin_util.events.parse_version(args['since'])
+            if since is None:
+                # A version from before the server restarted, so send every pin and have the client drop the rest
+                headers['X-Pins-Removed'] = '*'
+                return pin_response(lambda: pin_json.all(pin_util, skip), f"{version}-*-{skip:d}", headers)
+            headers['X-Pins-Removed'] = ','.join(str(id) for id in pin_util.events.removed_since(since))
+            return pin_response(lambda: pin_json.pins(pin_util.changed_since(since), skip),
+                                f"{version}-{since}-{skip:d}", headers)
+        return pin_response(lambda: pin_json.all(pin_util, skip), f"{version}-{skip:d}", headers)
 
     @ns.expect(pin_model)
     @ns.marshal_with(pin_model, code=201)
@@ -269,24 +1377,40 @@ class PinList(Resource):
         """Create a new pin"""
         return pin_util.create(api.payload)
 
+    @ns.expect([batch_change_model])
+    @ns.marshal_list_with(pin_model)
+    def patch(self):
+        """Change the state of several pins at once, returning the pins changed"""
+        print('Batch update', api.payload)
+        return pin_util.batch(api.payload)
+
 
 @ns.route('/<int:id>')
 @ns.response(404, 'pin not found')
 @ns.param('id', 'The pin identifier')
 @ns.param('state', 'Pin state on, off, or pulse')
+@ns.param('wait', 'For pulse, wait until the pulse has finished before replying')
+@ns.param('skip_none', 'Leave out fields that are not set')
 class Pin(Resource):
     """Show a single pin item and lets you update it"""
 
-    @ns.marshal_with(pin_model)
+    @ns.response(200, 'Success', pin_model)
+    @ns.response(304, 'pin not modified since If-None-Match')
     def get(self, id):
         """Fetch a pin given its resource identifier. Optionally set the state"""
         parser = reqparse.RequestParser()
-        parser.add_argument('state', choices=('on', 'off', 'pulse', 'pulse01') )
+        parser.add_argument('state', choices=PIN_STATES)
+        parser.add_argument('wait', type=inputs.boolean, default=False)
+        parser.add_argument('skip_none', type=inputs.boolean, default=SKIP_NONE)
         args = parser.parse_args()
+        skip = args.pop('skip_none')
         print('Get pin ID', id, args)
         if args['state']:
-            return pin_util.update(id, args)
-        return pin_util.get(id)
+            pin = pin_util.update(id, args)
+        else:
+            pin = pin_util.view(id)
+        return pin_response(lambda: pin_json.pin(pin, skip),
+                            f"{pin_util.events.epoch}-{pin['id']}-{pin['version']}-{skip:d}")
 
     # @ns.expect(pin_model, validate=True)
     @ns.expect(pin_model)
@@ -299,24 +1423,30 @@ class Pin(Resource):
 @ns.route('/name/<string:name>')
 @ns.response(404, 'pin not found')
 @ns.param('name', 'The pin function name')
+@ns.param('skip_none', 'Leave out fields that are not set')
 class PinName(Resource):
     """Show a single pin item and lets you update it"""
 
-    @ns.marshal_with(pin_model)
+    @ns.response(200, 'Success', pin_model)
+    @ns.response(304, 'pin not modified since If-None-Match')
     def get(self, name):
         
         """Fetch a pin given its function name. Optionally set the state"""
         parser = reqparse.RequestParser()
-        parser.add_argument('state', choices=('on', 'off', 'pulse', 'pulse01') )
+        parser.add_argument('state', choices=PIN_STATES)
+        parser.add_argument('wait', type=inputs.boolean, default=False)
+        parser.add_argument('skip_none', type=inputs.boolean, default=SKIP_NONE)
         args = parser.parse_args()
+        skip = args.pop('skip_none')
         print('Get pin with name', name, args)
 
-        for pin in pin_util.pins:
-            if pin['name'] == name:
-                if args['state']:
-                    return pin_util.update(pin['id'], args)
-                return pin_util.get(pin['id'])
-        api.abort(404, f"pin {name} doesn't exist.")
+        pin = pin_util.find(name)
+        if args['state']:
+            pin = pin_util.update(pin.id, args)
+        else:
+            pin = pin_util.view(pin.id)
+        return pin_response(lambda: pin_json.pin(pin, skip),
+                            f"{pin_util.events.epoch}-{pin['id']}-{pin['version']}-{skip:d}")
     
     # @ns.expect(pin_model, validate=True)
     @ns.expect(pin_model)
@@ -325,105 +1455,245 @@ class PinName(Resource):
         #record = json.loads(request.data)
         print('Putting pin with name', name, "payload", api.payload, request.data)
         """Update a pin given its function name"""
-        for pin in pin_util.pins:
-            # print('Checking', pin['name'])
-            if pin['name'] == name:
-                print('Updating', pin['name'], "payload", api.payload)
-                return pin_util.update(pin['id'], api.payload)
-        api.abort(404, f"pin {name} doesn't exist.")
+        pin = pin_util.find(name)
+        print('Updating', pin.name, "payload", api.payload)
+        return pin_util.update(pin.id, api.payload)
+
+
+event_streams = BoundedSemaphore(MAX_EVENT_STREAMS)
+
+
+@ns.route('/events')
+@ns.param('since', 'Id of the last event seen, to carry on from there')
+@ns.param('name', 'Only send events for this pin (can be repeated, or comma separated)')
+@ns.response(503, 'too many clients are already following the events')
+class PinEventStream(Resource):
+    """Stream pin state changes as Server-Sent Events"""
+
+    def get(self):
+        """Follow pin changes as they happen"""
+        parser = reqparse.RequestParser()
+        parser.add_argument('since')
+        parser.add_argument('name', action='append')
+        args = parser.parse_args()
+        # An id from before the server restarted gets a snapshot, as the sequence has started again
+        since = pin_util.events.parse_version(args['since'] or request.headers.get('Last-Event-ID'))
+        names = {n for name in args['name'] or () for n in name.split(',')}
+        if not event_streams.acquire(blocking=False):
+            api.abort(503, f"Already streaming events to {MAX_EVENT_STREAMS} clients")
+        print('Streaming events since', since, 'for', names or 'all pins')
+        response = Response(pin_util.stream(since, names), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # The server closes the response once sending to the client fails, usually on the second keepalive after it has gone
+        response.call_on_close(event_streams.release)
+        return response
+
+
+@ns.route('/name/<string:name>/bells')
+@ns.response(404, 'pin not found')
+@ns.param('name', 'The pin function name')
+class PinBells(Resource):
+    """Ring a bell code on an output pin"""
+
+    @ns.expect(bells_model)
+    @ns.marshal_with(sequence_model, code=202)
+    def post(self, name):
+        """Queue a bell code or pulse pattern, returning a sequence to poll or cancel"""
+        print('Ringing pin with name', name, "payload", api.payload)
+        return pin_util.ring(name, api.payload), 202
+
+
+@ns.route('/sequences/<int:id>')
+@ns.response(404, 'sequence not found')
+@ns.param('id', 'The sequence identifier')
+class Sequence(Resource):
+    """Show or cancel a queued bell code"""
+
+    @ns.marshal_with(sequence_model)
+    def get(self, id):
+        """Fetch the progress of a sequence"""
+        return pin_util.get_sequence(id)
+
+    @ns.marshal_with(sequence_model)
+    def delete(self, id):
+        """Cancel the rest of a sequence"""
+        print('Cancelling sequence', id)
+        return pin_util.cancel_sequence(id)
+
+
+@ns.route('/patterns')
+class PatternList(Resource):
+    """List the lightshow patterns the server can play"""
+
+    @ns.marshal_list_with(pattern_model)
+    def get(self):
+        """List the built-in patterns and their parameters"""
+        return pin_util.available_patterns()
+
+
+@ns.route('/shows')
+class ShowList(Resource):
+    """Play lightshow patterns on the Pi rather than step by step over HTTP"""
+
+    @ns.marshal_list_with(show_model)
+    def get(self):
+        """List the shows playing and recently finished"""
+        return list(pin_util.shows.values())
+
+    @ns.expect(show_request_model)
+    @ns.marshal_with(show_model, code=201)
+    def post(self):
+        """Start a pattern on a group of pins, stopping any other show on them"""
+        print('Starting show', api.payload)
+        return pin_util.start_show(api.payload), 201
+
+
+@ns.route('/shows/<int:id>')
+@ns.response(404, 'show not found')
+@ns.param('id', 'The show identifier')
+class Show(Resource):
+    """Show or stop a lightshow"""
+
+    @ns.marshal_with(show_model)
+    def get(self, id):
+        """Fetch the progress of a show"""
+        return pin_util.get_show(id)
+
+    @ns.marshal_with(show_model)
+    def delete(self, id):
+        """Stop a show and put its pins back as they were"""
+        print('Stopping show', id)
+        return pin_util.stop_show(id)
+
+
+def reload_layout(new_mode=None, new_host=None):
+    """ Load a layout and apply the differences to the running pins """
+    global mode, host
+    layout = load_layout(new_mode or mode, new_host or host)
+    print(f"Reloading layout {layout['path']}, host is {layout['host']}")
+    pin_util.set_pull_up_down(GPIO.PUD_UP if layout['pull_up_down'] == 'up' else GPIO.PUD_DOWN)
+    pin_util.set_serial(layout['serial_port'], layout['serial_baudrate'])
+    summary = pin_util.reload(layout['pins'])
+    pin_util.preload_media()
+    pin_util.set_shutdown_pins(layout['shutdown_pins'], layout['shutdown_inhibit_pins'],
+                              GPIO.LOW if layout['shutdown_active'] == 'low' else GPIO.HIGH)
+    if pin_util.journal is not None:
+        # The new layout replaces any changes made through the API
+        pin_util.start_journal(pin_util.journal, {'layout': layout['path'], 'host': layout['host']},
+                               keep_configs=False)
+    mode, host = new_mode or mode, new_host or host
+    return summary
+
+
+reload_model = api.model('reload', {
+    'mode': fields.String(required=False, description='layout to load, if not the current one'),
+    'host': fields.String(required=False, description='host for the URLs, if not the current one'),
+})
+
+reload_summary_model = api.model('reload_summary', {
+    'added': fields.List(fields.String, description='names of the pins added'),
+    'removed': fields.List(fields.String, description='names of the pins removed'),
+    'changed': fields.List(fields.String, description='names of the pins reconfigured'),
+    'unchanged': fields.List(fields.String, description='names of the pins left alone'),
+})
+
+
+@admin_ns.route('/reload')
+class Reload(Resource):
+    """Reload the pin layout without restarting"""
+
+    @admin_ns.expect(reload_model)
+    @admin_ns.marshal_with(reload_summary_model)
+    @admin_ns.response(400, 'layout could not be loaded')
+    def post(self):
+        """Apply the current (or another) layout file to the running pins"""
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            api.abort(400, "reload should be an object")
+        for key in ('mode', 'host'):
+            if data.get(key) is not None and not isinstance(data[key], str):
+                api.abort(400, f"{key} should be a string")
+        try:
+            return reload_layout(data.get('mode'), data.get('host'))
+        except (OSError, LayoutError) as e:
+            api.abort(400, f"Can't load layout: {e}")
+
+
+def hangup(signum, frame):
+    """ Reload the layout on SIGHUP, away from the signal handler """
+    def run():
+        try:
+            reload_layout()
+        except (OSError, LayoutError) as e:
+            print(f"Can't reload layout: {e}")
+        except HTTPException as e:
+            print(f"Can't reload layout: {e.description}")
+    Thread(target=run, name='reload').start()
+
+
+def serve():
+    """
+    Run the API. Everything lives in this one process with the GPIO, so
+    it is served by threads rather than by several worker processes.
+    """
+    if SERVER == 'waitress':
+        try:
+            import waitress
+        except ImportError:
+            print("waitress isn't installed, so using Flask's development server (pip3 install waitress)")
+        else:
+            waitress.serve(app, host='0.0.0.0', port=PORT, threads=SERVER_THREADS,
+                           connection_limit=SERVER_CONNECTIONS)
+            return
+    app.run(debug=False, host='0.0.0.0', port=PORT, threaded=True)
 
 
 if __name__ == '__main__':
     GPIO.setmode(GPIO.BCM)
-    host = 'http://localhost:5000/pins/name'
+    host = None
     mode = "levers"
 
     pin_util = PinUtil()
 
+    # The mode is the name of a layout in layouts/, or the path of a layout file
     if len(sys.argv) > 1:
         mode = sys.argv[1]
 
     if len(sys.argv) > 2:
         host = sys.argv[2]
 
-    print (f"mode is {mode}, host is {host}")
+    try:
+        layout = load_layout(mode, host)
+    except (OSError, LayoutError) as e:
+        print(f"Can't load layout {mode}: {e}")
+        sys.exit(1)
 
-    if mode == 'vidlooper':
-        pin_util.set_pull_up_down(GPIO.PUD_UP)
-        splash = "/home/pi/Pictures/Edwardian Lowdham.jpg"
-        # Shutdown by pressing buttons 1 and 2 for 2 seconds
-        shutdown_pins = [26, 19]
-        shutdown_inhibit_pins = []
+    print (f"mode is {mode} from {layout['path']}, host is {layout['host']}")
 
-        pin_util.create({'pin_num': 21, 'name': 'led1', 'state': 'off', 'direction': 'out'})
-        pin_util.create({'pin_num': 20, 'name': 'led2', 'state': 'off', 'direction': 'out'})
-        pin_util.create({'pin_num': 16, 'name': 'led3', 'state': 'off', 'direction': 'out'})
-        pin_util.create({'pin_num': 12, 'name': 'led4', 'state': 'off', 'direction': 'out'})
-        
-        pin_util.create({'pin_num': 26, 'name': 'button1',  'direction': 'in', 'falling_url': f'{host}/led1?state=off', 'rising_url': f'{host}/led1?state=on'})
-        pin_util.create({'pin_num': 19, 'name': 'button2',  'direction': 'in', 'falling_url': f'{host}/led2?state=off', 'rising_url': f'{host}/led2?state=on'})
-        pin_util.create({'pin_num': 13, 'name': 'button3',  'direction': 'in', 'rising_url': f'{host}/led3?state=pulse'})
-        pin_util.create({'pin_num':  6, 'name': 'button4',  'direction': 'in', 'falling_url': f'{host}/led4?state=off', 'rising_url': f'{host}/led4?state=on'})
-
-    elif mode == 'block':
-        pin_util.set_pull_up_down(GPIO.PUD_UP)
-        splash = None
-        # Shutdown by pressing both bell tappers for 2 seconds
-        shutdown_pins = [17, 13]
-        shutdown_inhibit_pins = []
-
-        pin_util.create({'pin_num': 21, 'name': 'appr_bell',  'state': 'off', 'direction': 'out'})
-        pin_util.create({'pin_num': 20, 'name': 'tc4601',     'state': 'off', 'direction': 'out'})
-        pin_util.create({'pin_num': 16, 'name': 'lh-bj-bell', 'state': 'off', 'direction': 'out'})
-        pin_util.create({'pin_num': 12, 'name': 'lh-bj-lc',   'state': 'off', 'direction': 'out'})
-        pin_util.create({'pin_num': 25, 'name': 'lh-bj-tol',  'state': 'off', 'direction': 'out'})
-        pin_util.create({'pin_num': 24, 'name': 'lh-th-lc',   'state': 'off', 'direction': 'out'})
-        pin_util.create({'pin_num': 23, 'name': 'lh-th-tol',  'state': 'off', 'direction': 'out'})
-        pin_util.create({'pin_num': 18, 'name': 'lh-th-bell', 'state': 'off', 'direction': 'out'})
-
-        pin_util.create({'pin_num': 17, 'name': 'th-lh-tap',  'direction': 'in', 'falling_url': f'{host}/th-lh-tap/on'})
-        pin_util.create({'pin_num': 27, 'name': 'th-lh-tol',  'direction': 'in', 'falling_url': f'{host}/th-lh-tol/off', 'rising_url': f'{host}/th-lh-tol/on'})
-        pin_util.create({'pin_num': 22, 'name': 'th-lh-lc',   'direction': 'in', 'falling_url': f'{host}/th-lh-lc/off',  'rising_url': f'{host}/th-lh-lc/on'})
-        pin_util.create({'pin_num':  5, 'name': 'bj-lh-tol',  'direction': 'in', 'falling_url': f'{host}/bj-lh-tol/off', 'rising_url': f'{host}/bj-lh-tol/on'})
-        pin_util.create({'pin_num':  6, 'name': 'bj-lh-lc',   'direction': 'in', 'falling_url': f'{host}/bj-lh-lc/off',  'rising_url': f'{host}/bj-lh-lc/on'})
-        pin_util.create({'pin_num': 13, 'name': 'bj-lh-tap',  'direction': 'in', 'falling_url': f'{host}/bj-lh-tap/on'})
-
-    elif mode ==  'levers':
-        pin_util.set_pull_up_down(GPIO.PUD_DOWN)
-        splash = "/home/pi/Pictures/Lowdham in 1956 Malcolm Fletcher.jpg"
-        # splash = "Videos/8 (photographer Spree) - Spree died 1932.jpg"
-
-        # Shutdown by pulling both starters (levers 3 and 11] but with homes at danger [levers 2 and 12]
-        shutdown_pins = [24, 5]
-        shutdown_inhibit_pins = [23, 6]
-
-        pin_util.create({'pin_num': 18, 'name': 'lever-1',  'direction': 'in', 'falling_url': f'{host}/lever/1/R', 'rising_url': f'{host}/lever/1/N',
-                         'falling_video': '/home/pi/Music/3-Stopping local-L-R.mp3'})
-        pin_util.create({'pin_num': 23, 'name': 'lever-2',  'direction': 'in', 'falling_url': f'{host}/lever/2/R', 'rising_url': f'{host}/lever/2/N'})
-        pin_util.create({'pin_num': 24, 'name': 'lever-3',  'direction': 'in', 'falling_url': f'{host}/lever/3/R', 'rising_url': f'{host}/lever/3/N'})
-        pin_util.create({'pin_num': 25, 'name': 'lever-4',  'direction': 'in', 'falling_url': f'{host}/lever/4/R', 'rising_url': f'{host}/lever/4/N',
-                         'falling_serial': '4N', 'rising_serial': '4R'})
-        pin_util.create({'pin_num': 12, 'name': 'lever-5',  'direction': 'in', 'falling_url': f'{host}/lever/5/R', 'rising_url': f'{host}/lever/5/N'})
-        pin_util.create({'pin_num': 16, 'name': 'lever-6',  'direction': 'in', 'falling_url': f'{host}/lever/6/R', 'rising_url': f'{host}/lever/6/N'})
-        pin_util.create({'pin_num': 20, 'name': 'lever-7',  'direction': 'in', 'falling_url': f'{host}/lever/7/R', 'rising_url': f'{host}/lever/7/N'})
-        # pin_util.create({'pin_num': 21, 'name': 'spare',   'direction': 'in', 'falling_url': f'{host}/lever/x/R', 'rising_url': f'{host}/lever/x/N'})
-
-        pin_util.create({'pin_num': 17, 'name': 'lever-8',  'direction': 'in', 'falling_url': f'{host}/lever/8/R', 'rising_url': f'{host}/lever/8/N'})
-        pin_util.create({'pin_num': 27, 'name': 'lever-9',  'direction': 'in', 'falling_url': f'{host}/lever/9/R', 'rising_url': f'{host}/lever/9/N'})
-        pin_util.create({'pin_num': 22, 'name': 'lever-10',  'direction': 'in', 'falling_url': f'{host}/lever/10/R', 'rising_url': f'{host}/lever/10/N'})
-        pin_util.create({'pin_num':  5, 'name': 'lever-11',  'direction': 'in', 'falling_url': f'{host}/lever/11/R', 'rising_url': f'{host}/lever/11/N',
-                         'falling_serial': '10N', 'rising_serial': '10R'})
-        pin_util.create({'pin_num':  6, 'name': 'lever-12',  'direction': 'in', 'falling_url': f'{host}/lever/12/R', 'rising_url': f'{host}/lever/12/N'})
-        pin_util.create({'pin_num': 13, 'name': 'lever-13',  'direction': 'in', 'falling_url': f'{host}/lever/13/R', 'rising_url': f'{host}/lever/13/N',
-                         'falling_video': '/home/pi/Music/4-Steam train non-stop R-L.mp3'})
-        pin_util.create({'pin_num': 19, 'name': 'lever-14',  'direction': 'in', 'falling_url': f'{host}/lever/14/R', 'rising_url': f'{host}/lever/14/N',
-                         'rising_video': '/home/pi/Videos/1-Gates-opening.mp4', 'falling_video': '/home/pi/Videos/2-Gates-closing.mp4'})
-        # pin_util.create({'pin_num': 26, 'name': 'spare2',   'direction': 'in', 'falling_url': f'{host}/lever/y/R', 'rising_url': f'{host}/lever/y/N'})
+    pin_util.set_pull_up_down(GPIO.PUD_UP if layout['pull_up_down'] == 'up' else GPIO.PUD_DOWN)
+    pin_util.set_serial(layout['serial_port'], layout['serial_baudrate'])
+    splash = layout['splash']
+    # Put the pins back as they were before a restart, before taking any requests
+    journal = Journal(JOURNAL_FILE)
+    header = {'layout': layout['path'], 'host': layout['host']}
+    pin_util.create_many(pin_util.restore(journal, header, layout['pins']))
+    pin_util.start_journal(journal, header)
+    pin_util.set_shutdown_pins(layout['shutdown_pins'], layout['shutdown_inhibit_pins'],
+                              GPIO.LOW if layout['shutdown_active'] == 'low' else GPIO.HIGH)
+    pin_util.preload_media()
 
+    signal.signal(signal.SIGHUP, hangup)
+
+    _splashproc = None
     if splash:
         _splashproc = Popen(['fbi', '--noverbose', '-a', splash])
 
-    app.run(debug=False, host='0.0.0.0')
+    serve()
+
+    pin_util.player.stop()
+    journal.flush()
+    if pin_util.serial is not None:
+        pin_util.serial.close()
 
     if _splashproc:
-        os.killpg(os.getpgid(_splashproc.pid), signal.SIGKILL)
\ No newline at end of file
+        os.killpg(os.getpgid(_splashproc.pid), signal.SIGKILL)
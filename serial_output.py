@@ -0,0 +1,107 @@
+# Send the rising_serial/falling_serial strings to a serial port
+#
+# For testing without the hardware, make_pty() gives a pseudo-terminal to
+# use as the port, and whatever is written can be read from its master:
+#     master, port = make_pty()
+#     out = SerialOutput(port)
+#     out.write('4R')
+#     os.read(master, 100)    # b'4R\n'
+
+import os
+import time
+import tty
+from collections import deque
+from threading import Condition, Thread
+
+import serial
+
+SERIAL_PORT = '/dev/rfcomm0'
+SERIAL_BAUDRATE = 9600
+QUEUE_SIZE = 64
+BATCH_WINDOW = 0.005      # secs to wait for more strings to send with the first
+RECONNECT_DELAY = 1.0     # secs, doubled on each failure up to MAX_RECONNECT_DELAY
+MAX_RECONNECT_DELAY = 10.0
+
+
+class SerialOutput(object):
+    """
+    Keep a serial port open and write to it from a background thread.
+
+    write() only queues the string, so it never waits on the port. The
+    writer sends strings that arrive within BATCH_WINDOW of each other in
+    one write. If the port can't be opened, or drops (as /dev/rfcomm0 does
+    when the Bluetooth link goes), it keeps trying to reopen it, holding on
+    to the most recent QUEUE_SIZE strings meanwhile.
+    """
+    def __init__(self, port=SERIAL_PORT, baudrate=SERIAL_BAUDRATE, terminator='\n'):
+        self.port = port
+        self.baudrate = baudrate
+        self.terminator = terminator
+        self.dropped = 0
+        self._queue = deque()
+        self._cond = Condition()
+        self._ser = None
+        self._stopped = False
+        Thread(target=self._run, name='serial', daemon=True).start()
+
+    def write(self, text):
+        with self._cond:
+            if len(self._queue) >= QUEUE_SIZE:
+                print(f"Serial queue full, dropping {self._queue[0]}")
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append(text)
+            self._cond.notify()
+
+    def close(self):
+        """ Stop the writer and close the port, dropping anything not yet sent """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _run(self):
+        delay = RECONNECT_DELAY
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._stopped)
+                if self._stopped:
+                    break
+            # Give anything else sent at the same moment a chance to join in
+            time.sleep(BATCH_WINDOW)
+            with self._cond:
+                batch = list(self._queue)
+                self._queue.clear()
+
+            try:
+                if self._ser is None:
+                    self._ser = serial.Serial(self.port, self.baudrate, write_timeout=1)
+                    print(f"Opened serial port {self._ser.name}")
+                self._ser.write(''.join(text + self.terminator for text in batch).encode())
+                delay = RECONNECT_DELAY
+            except (serial.SerialException, OSError) as e:
+                print(f"Serial port {self.port} failed ({e}), retrying in {delay}s")
+                self._close()
+                with self._cond:
+                    # Put the batch back in front of anything newer
+                    self._queue.extendleft(reversed(batch))
+                    while len(self._queue) > QUEUE_SIZE:
+                        self._queue.popleft()
+                        self.dropped += 1
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        self._close()
+
+    def _close(self):
+        if self._ser is not None:
+            try:
+                self._ser.close()
+            except (serial.SerialException, OSError):
+                pass
+            self._ser = None
+
+
+def make_pty():
+    """ A pseudo-terminal to stand in for the serial port. Returns its master fd and the port name """
+    master, slave = os.openpty()
+    tty.setraw(master)
+    return master, os.ttyname(slave)
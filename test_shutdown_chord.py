@@ -0,0 +1,91 @@
+# Check the shutdown chord in the shipped layouts on a simulated GPIO
+#
+#   python3 -m unittest test_shutdown_chord
+
+import contextlib, importlib.util, os, time, unittest
+
+os.environ['GPIO_BACKEND'] = 'sim'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SETTLE = 0.3    # secs for an edge to get through the debouncer
+
+
+def load_app():
+    """ Import restful-pi-sigbox.py, which can't be imported by name """
+    spec = importlib.util.spec_from_file_location('sigbox', os.path.join(HERE, 'restful-pi-sigbox.py'))
+    sigbox = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sigbox)
+    return sigbox
+
+
+class ShutdownChordTest(unittest.TestCase):
+    sigbox = None
+
+    def start(self, mode):
+        """ Set up the pins and shutdown chord of a layout, as the server does at startup """
+        if ShutdownChordTest.sigbox is None:
+            ShutdownChordTest.sigbox = load_app()
+        sigbox = self.sigbox
+        quiet = contextlib.redirect_stdout(open(os.devnull, 'w'))
+        quiet.__enter__()
+        self.addCleanup(quiet.__exit__, None, None, None)
+        # Start from the pull up or down levels of this layout, not where the last test left the inputs
+        sigbox.GPIO.cleanup()
+        sigbox.GPIO.levels.clear()
+        layout = sigbox.load_layout(mode, 'http://localhost:9')
+        sigbox.pin_util = pin_util = sigbox.PinUtil()
+        pin_util.set_pull_up_down(sigbox.GPIO.PUD_UP if layout['pull_up_down'] == 'up' else sigbox.GPIO.PUD_DOWN)
+        pin_util.create_many(layout['pins'])
+        pin_util.set_shutdown_pins(layout['shutdown_pins'], layout['shutdown_inhibit_pins'],
+                                   sigbox.GPIO.LOW if layout['shutdown_active'] == 'low' else sigbox.GPIO.HIGH)
+        self.chord = pin_util.shutdown_chord
+        self.chord.hold_time = 0.5
+        self.fired = []
+        self.chord.on_chord = lambda: self.fired.append(mode)
+        return layout
+
+    def set_inputs(self, levels):
+        for pin_num, level in levels.items():
+            self.sigbox.GPIO.set_input(pin_num, level)
+        time.sleep(SETTLE)
+
+    def tap(self, pin_num):
+        self.set_inputs({pin_num: 0})
+        self.assertFalse(self.chord.armed)
+        self.set_inputs({pin_num: 1})
+        self.assertFalse(self.chord.armed)
+
+    def test_single_tap_in_block_does_not_shut_down(self):
+        layout = self.start('block')
+        for pin_num in layout['shutdown_pins']:
+            self.tap(pin_num)
+        time.sleep(self.chord.hold_time)
+        self.assertEqual(self.fired, [])
+
+    def test_single_press_in_vidlooper_does_not_shut_down(self):
+        layout = self.start('vidlooper')
+        self.tap(layout['shutdown_pins'][0])
+        time.sleep(self.chord.hold_time)
+        self.assertEqual(self.fired, [])
+
+    def test_holding_both_tappers_in_block_shuts_down(self):
+        layout = self.start('block')
+        self.set_inputs({pin_num: 0 for pin_num in layout['shutdown_pins']})
+        self.assertTrue(self.chord.armed)
+        time.sleep(self.chord.hold_time + 0.2)
+        self.assertEqual(self.fired, ['block'])
+
+    def test_levers_need_the_homes_at_danger(self):
+        layout = self.start('levers')
+        self.set_inputs({pin_num: 1 for pin_num in layout['shutdown_pins'] + layout['shutdown_inhibit_pins']})
+        self.set_inputs({layout['shutdown_inhibit_pins'][0]: 0})
+        self.set_inputs({pin_num: 0 for pin_num in layout['shutdown_pins']})
+        self.assertFalse(self.chord.armed)
+        self.set_inputs({layout['shutdown_inhibit_pins'][0]: 1})
+        self.set_inputs({layout['shutdown_pins'][0]: 1})
+        self.set_inputs({layout['shutdown_pins'][0]: 0})
+        self.assertTrue(self.chord.armed)
+
+
+if __name__ == '__main__':
+    unittest.main()